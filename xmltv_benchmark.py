@@ -0,0 +1,365 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    SYNOPSIS
+
+    xmltv_benchmark generates a deterministic synthetic xmltv guide
+    and measures how fast xmltv_tools handles it.
+    It can be found here:
+
+         https://github.com/tvgrabbers/xmltvtools/
+
+    USAGE
+
+    xmltv_benchmark.py [--channels <count>] [--days <count>] [--density <count>]
+                       [--flat] [--memory] [--json <file>]
+
+    The phases read_input, process_xml, process_requests and create_output
+    are timed separately. With --json the results, with the peak memory,
+    are also written as JSON to compare runs over versions.
+
+    REQUIREMENTS
+
+    * Python 2.6 or 2.7
+    * xmltv_tools.py in the same directory
+
+    LICENSE
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 2 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys, io, os, time, datetime, argparse, tempfile, gc, json, shutil
+import xmltv_tools
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2, we count the objects ourself
+
+try:
+    import resource
+except ImportError:
+    resource = None     # Not on Windows
+
+class Null_Output():
+    """ A binary output that only counts the bytes written to it """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# end Null_Output
+
+def generate_guide(file_name, channels = 100, days = 7, density = 48, nested = True):
+    """
+    Write a synthetic guide with the given number of channels, each with
+    density programmes a day over days. With nested the programmes get
+    credits, video and episode-num tags. The same arguments always give
+    the same file. Returns the number of programmes.
+    """
+    per_channel = max(1, days * density)
+    # The lengths vary around the slot a programme has on average
+    slot = 1440.0 / max(1, density)
+    lengths = [max(1, int(slot * f)) for f in (0.5, 1.0, 1.5, 1.0)]
+    start_time = datetime.datetime(2015, 5, 13, 6, 0)
+    guide = io.open(file_name, mode = 'wb')
+    guide.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+    guide.write(b'<!DOCTYPE tv SYSTEM "xmltv.dtd">\n')
+    guide.write(b'<tv generator-info-name="xmltv_benchmark">\n')
+    for c in range(channels):
+        guide.write((u'  <channel id="%s.bench">\n' % c).encode('utf-8'))
+        guide.write((u'    <display-name lang="nl">Zender %s</display-name>\n' % c).encode('utf-8'))
+        guide.write((u'    <icon src="http://example.com/logo/%s.png"/>\n' % c).encode('utf-8'))
+        guide.write(b'  </channel>\n')
+
+    for c in range(channels):
+        stop = start_time
+        for p in range(per_channel):
+            start = stop
+            stop = start + datetime.timedelta(minutes = lengths[(p + c) % len(lengths)])
+            lines = [u'  <programme start="%s +0200" stop="%s +0200" channel="%s.bench">' % \
+                    (start.strftime('%Y%m%d%H%M%S'), stop.strftime('%Y%m%d%H%M%S'), c)]
+            lines.append(u'    <title lang="nl">Programma %s &amp; meer</title>' % (p % 997))
+            if p % 2 == 0:
+                lines.append(u'    <sub-title lang="nl">Aflevering %s</sub-title>' % p)
+
+            lines.append(u'    <desc lang="nl">Omschrijving van programma %s op zender %s.</desc>' % (p, c))
+            if nested and p % 3 == 0:
+                lines.append(u'    <credits>')
+                lines.append(u'      <director>Regisseur %s</director>' % (p % 53))
+                lines.append(u'      <actor>Acteur %s</actor>' % (p % 101))
+                lines.append(u'      <actor>Acteur %s</actor>' % (p % 103))
+                lines.append(u'    </credits>')
+
+            lines.append(u'    <category lang="en">%s</category>' % ('movie', 'news', 'sports', 'series')[p % 4])
+            if nested:
+                lines.append(u'    <episode-num system="xmltv_ns">%s.%s.</episode-num>' % (p % 5, p % 20))
+
+            if nested and p % 4 != 3:
+                lines.append(u'    <video>')
+                lines.append(u'      <aspect>16:9</aspect>')
+                if p % 2 == 0:
+                    lines.append(u'      <quality>HDTV</quality>')
+
+                lines.append(u'    </video>')
+
+            lines.append(u'  </programme>\n')
+            guide.write(u'\n'.join(lines).encode('utf-8'))
+
+    guide.write(b'</tv>\n')
+    guide.close()
+    return per_channel * channels
+
+# end generate_guide()
+
+def load_guide(file_name):
+    """ Parse a guide with xmltv_tools and return the Process_XML object """
+    xmltv_tools.config.input_file = file_name
+    xmltv_tools.config.input = io.open(file_name, mode = 'rb')
+    xml = xmltv_tools.Process_XML()
+    if xml.read_input() != None or xml.process_xml() != None:
+        sys.stderr.write('Error parsing %s\n' % file_name)
+        return None
+
+    xmltv_tools.config.input.close()
+    return xml
+
+# end load_guide()
+
+def bench_serialize(xml, rounds = 1):
+    """ Render all programmes and return (count, seconds, bytes) """
+    output = Null_Output()
+    writer = xmltv_tools.XMLTV_Writer(output)
+    count = 0
+    start = time.time()
+    for r in range(rounds):
+        for chanid in xml.chan_list:
+            for p in xml.programs[chanid]:
+                writer.write_tag(p, 2)
+                count += 1
+
+    writer.flush()
+    return (count, time.time() - start, output.size)
+
+# end bench_serialize()
+
+def deep_size(obj, seen = None):
+    """ Return the memory in bytes used by obj and everything it refers to """
+    if seen == None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_size(k, seen) + deep_size(v, seen)
+
+    elif isinstance(obj, (list, tuple, set)):
+        for v in obj:
+            size += deep_size(v, seen)
+
+    elif hasattr(obj, '__slots__'):
+        for a in obj.__slots__:
+            size += deep_size(getattr(obj, a, None), seen)
+
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+
+    return size
+
+# end deep_size()
+
+def bench_memory(file_name):
+    """ Return (programmes, bytes) held by the parsed channels and programmes """
+    if tracemalloc != None:
+        gc.collect()
+        tracemalloc.start()
+        xml = load_guide(file_name)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    else:
+        xml = load_guide(file_name)
+        size = deep_size((xml.channels, xml.programs))
+
+    count = 0
+    for programs in xml.programs.values():
+        count += len(programs)
+
+    return (count, size)
+
+# end bench_memory()
+
+def peak_rss():
+    """ Return the peak resident memory of this process in MB or None """
+    if resource == None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, Mac OS X bytes
+    return peak / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+# end peak_rss()
+
+def bench_phases(file_name, work_dir, edit_ids):
+    """
+    Run the xmltv_tools pipeline on a guide, removing the HD tags on
+    the edit_ids channels, and return a dict with the seconds per phase
+    """
+    output_file = os.path.join(work_dir, 'bench.out')
+    argv = ['-I', file_name, '-O', output_file, '--log-file', os.path.join(work_dir, 'bench.log'), '-q', '-r',
+            '-x'] + edit_ids
+    config = xmltv_tools.config
+    # The log file takes over stderr
+    stderr = sys.stderr
+    if config.read_commandline(argv) != None:
+        sys.stderr = stderr
+        return None
+
+    phases = {}
+    try:
+        start = time.time()
+        xml = xmltv_tools.Process_XML(config.args.id_list)
+        if xml.read_input() != None:
+            return None
+
+        phases['read_input'] = time.time() - start
+        start = time.time()
+        if xml.process_xml() != None:
+            return None
+
+        phases['process_xml'] = time.time() - start
+        start = time.time()
+        if not xml.check_chanids():
+            return None
+
+        xml.process_requests()
+        phases['process_requests'] = time.time() - start
+        start = time.time()
+        xml.create_output()
+        phases['create_output'] = time.time() - start
+
+    finally:
+        config.close()
+        sys.stderr = stderr
+
+    count = 0
+    for programs in xml.programs.values():
+        count += len(programs)
+
+    return {'phases': phases, 'programmes': count, 'channels': len(xml.channels),
+            'input_bytes': os.path.getsize(file_name), 'output_bytes': os.path.getsize(output_file)}
+
+# end bench_phases()
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark xmltv_tools on a synthetic guide')
+    parser.add_argument('--channels', type = int, default = 100, dest = 'channels',
+                    metavar = '<count>', help = 'number of channels, default = 100')
+    parser.add_argument('--days', type = int, default = 7, dest = 'days',
+                    metavar = '<count>', help = 'number of days, default = 7')
+    parser.add_argument('--density', type = int, default = 48, dest = 'density',
+                    metavar = '<count>', help = 'programmes per channel per day, default = 48')
+    parser.add_argument('--flat', action = 'store_false', default = True, dest = 'nested',
+                    help = 'leave out the credits, video and episode-num tags')
+    parser.add_argument('--guide', type = str, default = None, dest = 'guide',
+                    metavar = '<file>', help = 'keep the generated guide in this file')
+    parser.add_argument('--memory', action = 'store_true', default = False, dest = 'memory',
+                    help = 'report the memory used by the parsed guide')
+    parser.add_argument('--json', type = str, default = None, dest = 'json',
+                    metavar = '<file>', help = 'write the results as JSON to this file, \'-\' for stdout')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix = 'xmltv_benchmark')
+    guide = os.path.join(work_dir, 'guide.xml') if args.guide == None else args.guide
+    report = {'version': xmltv_tools.config.version(True),
+              'python': sys.version.split()[0],
+              'guide': {'channels': args.channels, 'days': args.days,
+                        'density': args.density, 'nested': args.nested}}
+    # Keep stdout clean for the JSON
+    out = sys.stderr if args.json == '-' else sys.stdout
+    try:
+        if args.guide == None or not os.path.exists(guide):
+            start = time.time()
+            generate_guide(guide, args.channels, args.days, args.density, args.nested)
+            report['generate'] = time.time() - start
+
+        result = bench_phases(guide, work_dir, ['%s.bench' % c for c in range(min(10, args.channels))])
+        if result == None:
+            sys.stderr.write('Error processing %s\n' % guide)
+            return 2
+
+        report.update(result)
+        count = result['programmes']
+        total = sum(result['phases'].values())
+        for phase in ('read_input', 'process_xml', 'process_requests', 'create_output'):
+            seconds = result['phases'][phase]
+            out.write('%s: %.3f seconds\n' % (phase, seconds))
+
+        report['seconds'] = total
+        report['programmes_per_second'] = count / max(total, 0.001)
+        report['mb_per_second'] = result['input_bytes'] / 1048576.0 / max(total, 0.001)
+        out.write('total: %s programmes in %.2f seconds, %.0f programmes/second, %.1f MB/second\n' % \
+                (count, total, report['programmes_per_second'], report['mb_per_second']))
+
+        xml = load_guide(guide)
+        if xml == None:
+            return 2
+
+        count, seconds, size = bench_serialize(xml)
+        report['serialize'] = {'programmes': count, 'seconds': seconds, 'bytes': size,
+                               'programmes_per_second': count / max(seconds, 0.001)}
+        out.write('serialize: %s programmes in %.2f seconds, %.0f programmes/second, %.1f MB\n' % \
+                (count, seconds, count / max(seconds, 0.001), size / 1048576.0))
+        xml = None
+
+        if args.memory:
+            count, size = bench_memory(guide)
+            report['memory'] = {'programmes': count, 'bytes': size, 'bytes_per_programme': float(size) / max(1, count)}
+            out.write('memory: %s programmes in %.1f MB, %.0f bytes/programme\n' % \
+                    (count, size / 1048576.0, float(size) / max(1, count)))
+
+        report['peak_rss_mb'] = peak_rss()
+        if report['peak_rss_mb'] != None:
+            out.write('peak memory: %.1f MB\n' % report['peak_rss_mb'])
+
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+            sys.stdout.write('\n')
+
+        elif args.json != None:
+            report_file = open(args.json, 'w')
+            json.dump(report, report_file, indent = 2, sort_keys = True)
+            report_file.close()
+
+    finally:
+        shutil.rmtree(work_dir, True)
+
+    return 0
+
+# end main()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -39,8 +39,33 @@
 """
 
 import sys, codecs, locale, argparse
-import io, os, os.path, time, datetime
+import io, os, os.path, time, datetime, calendar, bisect, glob, heapq
+import zlib, bz2, hashlib, tempfile, array, cProfile, marshal, signal
 from xml.etree import cElementTree as ET
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue        # Python 3
+
+import threading
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None     # No xz support
+
 try:
     unichr(42)
 except NameError:
@@ -54,11 +79,36 @@ if sys.version_info[:2] < (2,6):
 elif sys.version_info[:2] >= (3,0):
     sys.stderr.write("xmltv_tools does not support Pyton 3 or higher.\nExpect errors while we proceed\n")
 
-def log(message, log_level = 1, log_target = 3):
-    # Prints a warning to stderr.
-    def now():
-         return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z') + ': '
+# The log file lines waiting to be written and the last timestamp
+log_buffer = []
+log_stamp = [None, u'']
+
+def log_time():
+    """ Return the log timestamp, only formatted again when the second changes """
+    second = int(time.time())
+    if log_stamp[0] != second:
+        log_stamp[0] = second
+        log_stamp[1] = datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S %Z') + ': '
+
+    return log_stamp[1]
+
+# end log_time()
+
+def log_enabled(log_level = 1, log_target = 3):
+    """ Check if a message would be logged, so it need not be formatted otherwise """
+    if log_level == 0:
+        return True
+
+    if not (log_level & config.log_level):
+        return False
+
+    return bool(((log_target & 1) and not config.quiet) or ((log_target & 2) and config.log_output != None))
 
+# end log_enabled()
+
+def log(message, log_level = 1, log_target = 3, args = None):
+    # Prints a warning to stderr.
+    # With args, message is only formatted with them if it is logged.
     try:
         # If config is not yet available
         if (config == None) and (log_target & 1):
@@ -66,20 +116,42 @@ def log(message, log_level = 1, log_target = 3):
             sys.stderr.write(message.encode("utf-8"))
             return
 
+        if not log_enabled(log_level, log_target):
+            return
+
+        if args != None:
+            message = message % args
+
         # Log to the screen
-        elif log_level == 0 or ((not config.quiet) and (log_level & config.log_level) and (log_target & 1)):
-            sys.stdout.write(message.encode("utf-8"))
+        if log_level == 0 or ((not config.quiet) and (log_target & 1)):
+            config.screen.write(message.encode("utf-8"))
 
-        # Log to the log-file
-        if (log_level == 0 or ((log_level & config.log_level) and (log_target & 2))) and config.log_output != None:
-           sys.stderr.write(now() + unicode(message.replace('\n','') + '\n'))
+        # Log to the log-file, collected until flush_log
+        if (log_level == 0 or (log_target & 2)) and config.log_output != None:
+            log_buffer.append(log_time() + unicode(message.replace('\n','') + '\n'))
+            if log_level == 0 or len(log_buffer) >= 100:
+                flush_log()
 
     except:
         print 'An error ocured while logging!'
-        sys.stderr.write(now() + 'An error: "%s" ocured while logging!\n' % sys.exc_info()[1])
+        sys.stderr.write(log_time() + 'An error: "%s" ocured while logging!\n' % sys.exc_info()[1])
 
 # end log()
 
+def flush_log():
+    """ Write the collected log lines to the log file """
+    if len(log_buffer) > 0:
+        try:
+            sys.stderr.write(u''.join(log_buffer))
+            sys.stderr.flush()
+
+        except:
+            pass
+
+        del log_buffer[:]
+
+# end flush_log()
+
 class Configure:
     def __init__(self):
         """
@@ -99,8 +171,33 @@ class Configure:
         self.log_file = ''
         self.log_level = 1
         self.quiet = False
+        # Where screen messages go. With the output on stdout this becomes stderr
+        self.screen = sys.stdout
         self.output = None
+        # The Atomic_Output under output, if it goes to a file
+        self.atomic_output = None
         self.input = None
+        # The number of characters collected before writing to the output
+        self.buffer_size = 65536
+        # A list of (input file, output file) tuples in batch mode
+        self.batch_jobs = None
+        # The number of processes to divide the channels of one file over
+        self.channel_jobs = 1
+        # The compression level for a .gz, .bz2 or .xz output
+        self.compress_level = 6
+        # The Operation objects to apply to the given channels in this order
+        self.operations = []
+        # Only programmes running between these times (seconds since the epoch) are read
+        self.time_from = None
+        self.time_until = None
+        # With --watch the input must be unchanged this many seconds before it is read
+        self.watch_settle = 5
+        # The number of threads writing the files with --split
+        self.split_writers = 4
+        # Some numbers on the processed file
+        self.counters = {}
+        # A Phase_Timer with --profile
+        self.profile = None
         self.tag_order = [{'name': 'programme', 'ident': 2, 'values':{
                                     0: 'title',
                                     1: 'sub-title',
@@ -138,8 +235,33 @@ class Configure:
                                     0: 'src',
                                     1: 'width',
                                     2: 'height'}}]
+        self.compile_order()
     # end Init()
 
+    def compile_order(self):
+        """
+        Turn tag_order and attrib_order into rank dicts keyed on (name, ident)
+        so create_tag can order children and attributes with one sort
+        """
+        def ranks(order_list):
+            rank_dict = {}
+            for o in order_list:
+                key = (o['name'], o['ident'])
+                if key in rank_dict:
+                    # Like before only the first matching definition counts
+                    continue
+
+                rank_dict[key] = {}
+                for i in range(len(o['values'])):
+                    rank_dict[key].setdefault(o['values'][i], i)
+
+            return rank_dict
+
+        self.tag_rank = ranks(self.tag_order)
+        self.attrib_rank = ranks(self.attrib_order)
+
+    # end compile_order()
+
     def version(self, as_string = False):
         """
         return tuple or string with version info
@@ -160,24 +282,27 @@ class Configure:
 
     def save_oldfile(self, file):
         """ save the old file to .old if it exists """
+        if not os.path.exists(file):
+            return
+
         try:
-            os.rename(file, file + '.old')
+            replace_file(file, file + '.old')
 
         except Exception as e:
             pass
 
     # end save_old()
 
-    def open_file(self, file_name, mode = 'rb', encoding = None):
+    def open_file(self, file_name, mode = 'rb', encoding = None, buffering = -1):
         """ Open a file and return a file handler if success """
         if encoding == None:
             encoding = self.file_encoding
 
         try:
             if 'b' in mode:
-                file_handler =  io.open(file_name, mode = mode)
+                file_handler =  io.open(file_name, mode = mode, buffering = buffering)
             else:
-                file_handler =  io.open(file_name, mode = mode, encoding = encoding)
+                file_handler =  io.open(file_name, mode = mode, encoding = encoding, buffering = buffering)
 
         except IOError as e:
             if e.errno == 2:
@@ -190,6 +315,68 @@ class Configure:
 
     # end open_file ()
 
+    def open_input(self, file_name, source = None):
+        """ Open the input, or use the given stream, and decompress it on the fly if it is compressed """
+        if source == None:
+            source = self.open_file(file_name, mode = 'rb')
+            if source == None:
+                return None
+
+        magic = source.read(6)
+        codec = compression_codec(magic = magic)
+        source = Prefixed_Reader(magic, source)
+        if codec == None:
+            return source
+
+        if codec == 'xz' and lzma == None:
+            log(u'File: "%s" is xz compressed, which needs the lzma module.\n' % file_name, 0)
+            source.close()
+            return None
+
+        return Decompress_Reader(source, codec)
+
+    # end open_input()
+
+    def open_output(self, file_name):
+        """ Open the output, compressed if the extension is .gz, .bz2 or .xz """
+        codec = compression_codec(file_name = file_name)
+        if codec == 'xz' and lzma == None:
+            log(u'File: "%s" needs the lzma module for xz compression.\n' % file_name, 0)
+            return None
+
+        try:
+            target = Atomic_Output(file_name, self.args.skip_unchanged, self.args.fsync)
+
+        except (IOError, OSError) as e:
+            log(u'File: "%s": %s.\n' % (file_name, e.strerror), 0)
+            return None
+
+        self.atomic_output = target
+        if codec == None:
+            return target
+
+        return Compress_Writer(target, codec, self.compress_level)
+
+    # end open_output()
+
+    def open_cache(self, cache_dir):
+        """ Return a Channel_Cache on cache_dir, creating the directory if needed """
+        cache_dir = os.path.realpath(cache_dir)
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+        except OSError:
+            pass
+
+        if not os.access(cache_dir, os.W_OK):
+            log(u'The cache directory: %s is not writable\n' % (cache_dir), 0)
+            return None
+
+        return Channel_Cache(cache_dir, self.args.cache_size * 1048576)
+
+    # end open_cache()
+
     def get_line(self, file, byteline, isremark = False, encoding = None):
         """
         Check line encoding and if valid return the line
@@ -222,7 +409,7 @@ class Configure:
 
     # end get_line()
 
-    def read_commandline(self):
+    def read_commandline(self, argv = None):
         """Initiate argparser and read the commandline"""
         v=self.version()
         self.description = 'The Netherlands: v%s.%s.%s\n' % (v[1], v[2], v[3]) + \
@@ -242,21 +429,119 @@ class Configure:
 
         parser.add_argument('-L', '--log-level', type = int, default = 1, dest = 'log_level',
                         metavar = '<level>',
-                        help = 'Set the loglevel [0-2] default = 1')
+                        help = 'Set the loglevel [0-7] as the sum of:\n' + \
+                                    '  1: the normal messages\n' + \
+                                    '  2: a line for every edited programme\n' + \
+                                    '  4: per channel one line with the edited programmes\n' + \
+                                    '0 only shows errors. Default = 1')
 
         parser.add_argument('-I', '--input', type = str, default = None, dest = 'input_file',
                         metavar = '<file>',
-                        help = 'file to read from')
+                        help = 'file to read from, \'-\' reads from stdin')
+
+        parser.add_argument('-B', '--batch', nargs = '+', default = None, dest = 'batch',
+                        metavar = '<file|dir|glob>',
+                        help = 'process a batch of files in parallel instead of --input.\n' + \
+                                    'A directory means all *.xml(.gz|.bz2|.xz) files in it.\n' + \
+                                    'The output goes to <name>.out(.gz|.bz2|.xz) in the\n' + \
+                                    '--output or input directory and every file gets its\n' + \
+                                    'own <file>.log')
+
+        parser.add_argument('-j', '--jobs', type = int, default = None, dest = 'jobs',
+                        metavar = '<count>',
+                        help = 'the number of files to process at the same time in\n' + \
+                                    'batch mode. Default = the number of cores.\n' + \
+                                    'For a single file the number of processes to divide\n' + \
+                                    'the channels over. Default = 1')
 
         parser.add_argument('-x', '--id-list', nargs = '*', dest = 'id_list',
                         metavar = '<xmltvID>',
                         help = 'The xmltvIDs to process.')
 
+        parser.add_argument('-e', '--extract', action = 'store_true', default = False, dest = 'extract',
+                        help = 'only output the channels given with -x. The others are\n' + \
+                                    'skipped while reading. Without -r, -t or -o the channels\n' + \
+                                    'are copied unchanged')
+
+        parser.add_argument('-m', '--merge', nargs = '+', default = None, dest = 'merge',
+                        metavar = '<file>',
+                        help = 'merge these xmltv files into the input. Channels are\n' + \
+                                    'taken from the first file that has them and where\n' + \
+                                    'programmes overlap the earlier file wins, the input\n' + \
+                                    'first. To also edit channels, pipe the result into\n' + \
+                                    'a second run')
+
         parser.add_argument('-O', '--output', type = str, default = None, dest = 'output_file',
                         metavar = '<file>',
                         help = 'file or directory where to send the output.\n' + \
                                     'Defaults to \'xmltv.out\' in the input directory. If just\n' + \
-                                    'a filename is given, the current directory is assumed.')
+                                    'a filename is given, the current directory is assumed.\n' + \
+                                    '\'-\' writes to stdout, the default when reading stdin.')
+
+        parser.add_argument('--split', type = str, default = None, dest = 'split',
+                        choices = ('channel', 'day'),
+                        help = 'write a file per channel or per day into the output\n' + \
+                                    'directory, by default \'xmltv.split\' in the input\n' + \
+                                    'directory. Files that did not change are not rewritten')
+
+        parser.add_argument('--export-db', type = str, default = None, dest = 'export_db',
+                        metavar = '<file>',
+                        help = 'write the result to a SQLite database instead of xmltv,\n' + \
+                                    'indexed on channel and time for --query-db')
+
+        parser.add_argument('--query-db', type = str, default = None, dest = 'query_db',
+                        metavar = '<file>',
+                        help = 'write xmltv with the programmes from a database made\n' + \
+                                    'with --export-db. Select the channels with -x and the\n' + \
+                                    'time with --from and --until. -I is not used and the\n' + \
+                                    'output defaults to stdout')
+
+        parser.add_argument('--from', type = str, default = None, dest = 'time_from',
+                        metavar = '<time>',
+                        help = 'leave out the programmes that end before this time.\n' + \
+                                    'Give \'now\', an offset from now like \'+2h\', \'-1d\' or\n' + \
+                                    '\'+30m\', or an xmltv time like \'20150513200000 +0200\'')
+
+        parser.add_argument('--until', type = str, default = None, dest = 'time_until',
+                        metavar = '<time>',
+                        help = 'leave out the programmes that start at or after this\n' + \
+                                    'time. Like --from, so \'--until +48h\' keeps two days')
+
+        parser.add_argument('--validate', action = 'store_true', default = False, dest = 'validate',
+                        help = 'check the given channels, or all without -x, for\n' + \
+                                    'overlapping programmes and gaps and log them. The\n' + \
+                                    'exit code is 3 if any are found')
+
+        parser.add_argument('--repair', type = int, nargs = '?', const = 5, default = None, dest = 'repair',
+                        metavar = '<minutes>',
+                        help = 'like --validate, but cut overlapping programmes short\n' + \
+                                    'at the start of the next, drop programmes with the\n' + \
+                                    'same start and close gaps up to <minutes> by extending\n' + \
+                                    'the programme before. The channels are written in\n' + \
+                                    'time order. The exit code is 3 if problems are left.\n' + \
+                                    'Default = 5 minutes')
+
+        parser.add_argument('--snapshot', type = str, default = None, dest = 'snapshot',
+                        metavar = '<file>',
+                        help = 'save the parsed input in <file> and on later runs load\n' + \
+                                    'it from there instead of parsing, as long as the input\n' + \
+                                    'did not change. Not used with stdin')
+
+        parser.add_argument('--cache-dir', type = str, default = None, dest = 'cache_dir',
+                        metavar = '<dir>',
+                        help = 'keep the processed channels in this directory and reuse\n' + \
+                                    'them next time if their programmes did not change')
+
+        parser.add_argument('--cache-size', type = int, default = 100, dest = 'cache_size',
+                        metavar = '<MB>',
+                        help = 'the size at which the least recently used channels are\n' + \
+                                    'removed from the cache. Default = 100 MB')
+
+        parser.add_argument('--log-file', type = str, default = None, dest = 'log_file',
+                        metavar = '<file>',
+                        help = 'the file to log to. Defaults to <input>.log. When reading\n' + \
+                                    'from stdin without a log file, there is no log file and\n' + \
+                                    'the messages go to stderr. Add -q to only show errors')
 
         parser.add_argument('-r', '--remove-HD-tags', action = 'store_true', default = None, dest = 'remove_hd_tags',
                         help = 'remove the HD tags from given channels <default action>')
@@ -264,18 +549,68 @@ class Configure:
         parser.add_argument('-t', '--add-HD-tags', action = 'store_false', default = None, dest = 'remove_hd_tags',
                         help = 'add a HD tag to all programs from given channels')
 
+        parser.add_argument('-o', '--operation', action = 'append', default = None, dest = 'operations',
+                        metavar = '<name[=argument]>',
+                        help = 'an operation to apply to the given channels. Repeat it\n' + \
+                                    'to chain them, they run in one pass after -r or -t:\n' + \
+                                    '  remove-hd, add-hd: remove or add the HDTV quality\n' + \
+                                    '  rename=<xmltvID>: a new xmltvID, \'%%s\' is the old one\n' + \
+                                    '  shift=<minutes>: move all start and stop times\n' + \
+                                    '  drop: leave the channels out')
+
         parser.add_argument('-n', '--add-new-id', action = 'store_true', default = False, dest = 'add_new_id',
                         help = 'Preserve the old listing and add the processed channel\n' + \
-                                    'with a new id, adding \'-sd\' or \'-hd\' to the old xmltvID')
+                                    'with a new id, adding \'-sd\' or \'-hd\' to the old xmltvID\n' + \
+                                    'or as given with --operation rename')
+
+        parser.add_argument('--profile', action = 'store_true', default = False, dest = 'profile',
+                        help = 'log the wall and CPU time and the number of elements\n' + \
+                                    'of every phase: parse, convert, check, transform,\n' + \
+                                    'serialize and write')
+
+        parser.add_argument('--profile-stats', type = str, default = None, dest = 'profile_stats',
+                        metavar = '<file>',
+                        help = 'also run under cProfile and save the statistics in\n' + \
+                                    '<file>, to read with the pstats module')
+
+        parser.add_argument('--watch', type = int, nargs = '?', const = 60, default = None, dest = 'watch',
+                        metavar = '<seconds>',
+                        help = 'keep running and process the input again every time\n' + \
+                                    'it changes, checking every <seconds>. A file is only\n' + \
+                                    'read when it stopped changing. Default = 60 seconds')
+
+        parser.add_argument('--skip-unchanged', action = 'store_true', default = False, dest = 'skip_unchanged',
+                        help = 'leave the output file alone if the new content is the\n' + \
+                                    'same. The output is always written to a temporary file\n' + \
+                                    'that replaces the old one when it is complete')
+
+        parser.add_argument('--fsync', action = 'store_true', default = False, dest = 'fsync',
+                        help = 'make sure the output is on disk before it replaces\n' + \
+                                    'the old one')
+
+        parser.add_argument('--buffer-size', type = int, default = None, dest = 'buffer_size',
+                        metavar = '<KB>',
+                        help = 'the amount of output collected before it is written\n' + \
+                                    'to disk. Default = 64 KB')
+
+        parser.add_argument('-z', '--compress-level', type = int, default = None, dest = 'compress_level',
+                        metavar = '<level>',
+                        help = 'the compression level [1-9] for an output ending on\n' + \
+                                    '.gz, .bz2 or .xz. Compressed input is detected\n' + \
+                                    'automatically. Default = 6')
 
         # Handle the sys.exit(0) exception on --help more gracefull
         try:
-            self.args = parser.parse_args()
+            self.args = parser.parse_args(argv)
 
         except:
             return(0)
 
+        if self.args.id_list == None:
+            self.args.id_list = []
+
         self.quiet = self.args.quiet
+        self.log_level = self.args.log_level
         if self.args.version:
             print("The Netherlands: %s" % self.version(True))
             return(0)
@@ -284,19 +619,157 @@ class Configure:
             print self.description
             return(0)
 
+        if self.args.buffer_size != None:
+            self.buffer_size = max(1, self.args.buffer_size) * 1024
+
+        if self.args.compress_level != None:
+            self.compress_level = min(9, max(1, self.args.compress_level))
+
+        if self.args.profile or self.args.profile_stats != None:
+            self.profile = Phase_Timer()
+
+        x = self.init_operations()
+        if x != None:
+            return(x)
+
+        x = self.init_time_window()
+        if x != None:
+            return(x)
+
+        if self.args.extract and not self.args.id_list:
+            print 'Please give the xmltvIDs to extract with -x\n'
+            return(1)
+
+        if self.args.merge != None and (self.args.batch != None or self.args.id_list):
+            print 'Merging can not be combined with --batch or -x\n'
+            return(1)
+
+        if self.args.split != None and (self.args.batch != None or self.args.merge != None):
+            print 'Splitting can not be combined with --batch or --merge\n'
+            return(1)
+
+        if self.args.export_db != None and (self.args.batch != None or self.args.merge != None or \
+          self.args.split != None):
+            print 'Exporting can not be combined with --batch, --merge or --split\n'
+            return(1)
+
+        if self.args.query_db != None and (self.args.batch != None or self.args.merge != None or \
+          self.args.split != None or self.args.export_db != None):
+            print 'Querying can not be combined with --batch, --merge, --split or --export-db\n'
+            return(1)
+
+        if self.args.watch != None and (self.args.batch != None or self.args.query_db != None or \
+          self.args.input_file == '-'):
+            print 'Watching can not be combined with --batch, --query-db or stdin\n'
+            return(1)
+
+        if (self.args.export_db != None or self.args.query_db != None) and sqlite3 == None:
+            print 'The sqlite3 module is needed for --export-db and --query-db\n'
+            return(1)
+
+        if self.args.query_db != None:
+            return self.init_query()
+
+        if self.args.batch != None:
+            return self.init_batch()
+
+        if self.args.jobs != None:
+            self.channel_jobs = max(1, self.args.jobs)
+
         if self.args.input_file == None:
             print 'Please give an xmltv file to process\n'
             return(1)
 
+        return self.init_files(self.args.input_file, self.args.output_file)
+
+    # end read_commandline()
+
+    def init_operations(self):
+        """ Build the chain of operations from --operation and the HD tag options """
+        self.operations = []
+        op_list = []
+        if self.args.remove_hd_tags == None and not self.args.operations and self.args.extract:
+            # just copy the extracted channels
+            pass
+
+        elif self.args.remove_hd_tags == True or (self.args.remove_hd_tags == None and not self.args.operations):
+            # removing HD tags is the default action
+            op_list.append('remove-hd')
+            if self.args.add_new_id:
+                op_list.append('rename=%s-sd')
+
+        elif self.args.remove_hd_tags == False:
+            op_list.append('add-hd')
+            if self.args.add_new_id:
+                op_list.append('rename=%s-hd')
+
+        if self.args.operations:
+            op_list.extend(self.args.operations)
+
+        for op in op_list:
+            name, argument = op.split('=', 1) if '=' in op else (op, None)
+            if not name in operations:
+                log(u'Unknown operation: "%s". Choose from: %s\n' % (name, u', '.join(sorted(operations.keys()))), 0)
+                return(1)
+
+            try:
+                self.operations.append(operations[name](argument))
+
+            except ValueError as e:
+                log(u'%s\n' % e, 0)
+                return(1)
+
+        return
+
+    # end init_operations()
+
+    def init_time_window(self):
+        """ Read --from and --until """
+        now = int(time.time())
+        for option, attrib in (('time_from', 'from'), ('time_until', 'until')):
+            value = getattr(self.args, option)
+            if value == None:
+                setattr(self, option, None)
+                continue
+
+            seconds = time_option(value, now)
+            if seconds == None:
+                log(u'Can not read the --%s time: "%s"\n' % (attrib, value), 0)
+                return(1)
+
+            setattr(self, option, seconds)
+
+        return
+
+    # end init_time_window()
+
+    def init_files(self, input_file, output_file = None):
+        """
+        Open the input, the log and the output file
+        A '-' for input_file or output_file means stdin or stdout
+        """
+        if output_file == '-' or (input_file == '-' and output_file == None):
+            # Keep the data stream clean
+            self.screen = sys.__stderr__
+
+        if input_file == '-':
+            self.input_file = u'<stdin>'
+
         else:
-            self.input_file =  os.path.realpath(self.args.input_file)
+            self.input_file =  os.path.realpath(input_file)
 
             if not os.access(self.input_file, os.R_OK):
                 log('The xmltv file: %s does not exist or is not readable\n' % (self.input_file))
                 return(1)
 
+        if self.args.log_file != None:
+            self.log_file = os.path.realpath(self.args.log_file)
+
+        elif input_file != '-':
             self.log_file = '%s.log' % self.input_file
-            try:
+
+        try:
+            if self.log_file != '':
                 self.save_oldfile(self.log_file)
                 self.log_output = self.open_file(self.log_file, mode = 'a')
                 if self.log_output != None:
@@ -306,26 +779,46 @@ class Configure:
                     log(u'Cannot write to logfile: %s\n' % self.log_file, 0)
                     return(2)
 
-                log(u"The Netherlands: %s\n" % config.version(True))
-                self.input = self.open_file(self.input_file)
+            log(u"The Netherlands: %s\n" % self.version(True))
+            if input_file == '-':
+                self.input = self.open_input(self.input_file, getattr(sys.stdin, 'buffer', sys.stdin))
 
-            except Exception:
-                log(u'Cannot write to logfile: %s\n' % self.log_file, 0)
-                return(2)
+            else:
+                self.input = self.open_input(self.input_file)
 
+        except Exception:
+            log(u'Cannot write to logfile: %s\n' % self.log_file, 0)
+            return(2)
+
+        if self.input == None:
+            return(1)
 
-        if self.args.id_list == None or len(self.args.id_list) == 0:
+        if len(self.args.id_list) == 0 and self.args.merge == None and \
+          self.args.export_db == None and not self.validate_only() and not self.window_only():
             log(u'Please give one or more xmltvID\'s to process\n', 0)
             return(1)
 
-        if self.args.output_file == None:
+        if self.args.split != None:
+            return self.init_split_dir(output_file)
+
+        if self.args.export_db != None:
+            log(u'exporting to %s\n' % os.path.realpath(self.args.export_db))
+            return
+
+        if output_file == '-' or (input_file == '-' and output_file == None):
+            self.output_file = u'<stdout>'
+            self.output = getattr(sys.stdout, 'buffer', sys.stdout)
+            log(u'using %s for the output\n' % self.output_file)
+            return
+
+        if output_file == None:
             self.output_file = u'%s/xmltv.out' % os.path.dirname(self.input_file)
 
-        elif self.args.output_file[-1] == '/' or  self.args.output_file[-1] == '.' or os.path.isdir(self.args.output_file):
-               self.output_file = os.path.realpath(u'%s/xmltv.out' % self.args.output_file)
+        elif output_file[-1] == '/' or  output_file[-1] == '.' or os.path.isdir(output_file):
+               self.output_file = os.path.realpath(u'%s/xmltv.out' % output_file)
 
         else:
-            self.output_file = os.path.realpath(self.args.output_file)
+            self.output_file = os.path.realpath(output_file)
 
         try:
             out_dir = os.path.dirname(self.output_file)
@@ -341,7 +834,9 @@ class Configure:
                 log(u'%s exists and is not writable\n' % (self.output_file), 0)
                 return(1)
 
-            self.output = self.open_file(self.output_file, mode = 'w')
+            self.output = self.open_output(self.output_file)
+            if self.output == None:
+                return(1)
 
         except:
             log(u'Error creating the output directory and or file: %s\n' % (self.output_file), 0)
@@ -350,391 +845,3005 @@ class Configure:
         log(u'using %s for the output\n' % self.output_file)
         return
 
-    # end read_commandline()
-
-    def close(self):
+    # end init_files()
 
-        # close everything neatly
-        try:
-            if self.input != None:
-                self.input.close()
+    def init_query(self):
+        """ Open the log and the output for --query-db """
+        if not os.access(self.args.query_db, os.R_OK):
+            log(u'The database: %s does not exist or is not readable\n' % (self.args.query_db), 0)
+            return(1)
 
-            if self.output != None:
-                self.output.close()
+        output_file = self.args.output_file
+        if output_file in (None, '-'):
+            # Keep the data stream clean
+            self.screen = sys.__stderr__
+            self.output_file = u'<stdout>'
+            self.output = getattr(sys.stdout, 'buffer', sys.stdout)
 
-            if self.log_output != None:
-                self.log_output.close()
+        else:
+            self.output_file = os.path.realpath(output_file)
+            self.output = self.open_output(self.output_file)
+            if self.output == None:
+                return(1)
 
-        except:
-            pass
+        if self.args.log_file != None:
+            self.log_file = os.path.realpath(self.args.log_file)
+            self.log_output = self.open_file(self.log_file, mode = 'a')
+            if self.log_output == None:
+                log(u'Cannot write to logfile: %s\n' % self.log_file, 0)
+                return(2)
 
-    # end close()
+            sys.stderr = self.log_output
 
-# end Configure
-config = Configure()
+        return
 
-class Process_XML():
-    def __init__(self):
-        self.channels = []
-        self.chan_list = []
-        self.programs = {}
-        self.out_string = u''
-        self.chan_out_string = u''
-        self.prog_out_string = u''
-    # end Init()
+    # end init_query()
 
-    def read_input(self):
-        try:
-            self.output_header = u''
-            for byteline in config.input.readlines():
-                line = config.get_line(config.input, byteline)
-                self.output_header += u'%s\n' % line
-                if line[0:3] == '<tv':
-                    break
+    def init_split_dir(self, output_dir):
+        """ Set output_file to the directory for --split and create it """
+        if output_dir == '-':
+            log(u'The --split files can not go to stdout\n', 0)
+            return(1)
 
-            self.input_string = u''
-            config.input.seek(0,0)
-            for byteline in config.input.readlines():
-                line = config.get_line(config.input, byteline)
-                self.input_string += u'%s\n' % line
+        if output_dir == None:
+            output_dir = os.path.join(os.path.dirname(self.input_file) or os.getcwd(), 'xmltv.split')
 
-            self.input_string += u''
-            self.et_object = ET.fromstring(self.input_string.encode('utf-8'))
+        self.output_file = os.path.realpath(output_dir)
+        try:
+            if not os.path.exists(self.output_file):
+                log(u'Creating %s directory,\n' % self.output_file)
+                os.makedirs(self.output_file)
 
         except:
-            log(u'error: %s parsing %s\n' % (sys.exc_info()[1], config.input), 0)
-            return 2
+            log(u'Error creating the output directory: %s\n' % (self.output_file), 0)
+            return(1)
 
-    # end read_input()
+        if not os.access(self.output_file, os.W_OK):
+            log(u'The output directory: %s is not writable\n' % (self.output_file), 0)
+            return(1)
 
-    def process_xml(self):
-        """
-        Every tag becomes a dict with 4 elements:
-            attribs: with a dict of attrib names and values
-            text: the text behind the starttag
-            tail: the text behind the endtag
-            tags: a list of dicts with 2 elements:
-                tag: the name
-                value: a dict like this
-        """
-        def read_tag(tag):
-            sdict = {}
-            sdict['text'] = None if tag.text == None else tag.text.strip()
-            sdict['tail'] = None if tag.tail == None else tag.tail.strip()
-            sdict['attribs'] ={}
-            sdict['tags'] =[]
-            for a, t in tag.attrib.items():
-                sdict['attribs'][a] = t
-
-            for t in tag.findall('./'):
-                sdict['tags'].append({'tag': t.tag, 'value': read_tag(t)})
-
-            return sdict
-
-        for c in self.et_object.findall('channel[@id]'):
-            c_id = c.get('id')
-            if c_id == None or c_id == '':
-                continue
+        log(u'using %s for the output\n' % self.output_file)
+        return
 
-            self.chan_list.append(c_id)
-            self.channels.append(read_tag(c))
-            self.programs[c_id] = []
+    # end init_split_dir()
 
-        for p in self.et_object.findall('programme[@channel]'):
-            c_id = p.get('channel')
-            if c_id == None or c_id == '':
-                continue
+    def validate_only(self):
+        """ Return True if --validate or --repair is given without channels to process """
+        if self.args.validate or self.args.repair != None:
+            if self.args.id_list == None:
+                self.args.id_list = []
 
-            if not c_id in self.programs.keys():
-                self.programs[c_id] = []
+            return len(self.args.id_list) == 0
 
-            self.programs[c_id].append(read_tag(p))
+        return False
 
-    # end process_xml()
+    # end validate_only()
 
-    def check_chanids(self):
-        cancel_processing = False
-        for chanid in config.args.id_list:
-            if not chanid in self.chan_list:
-                log(u'The requested xmltvID: "%s" is not found in the input file\n' % (chanid), 0)
-                cancel_processing = True
-            if config.args.add_new_id:
-                if config.args.remove_hd_tags == True and '%s-sd' % (chanid) in self.chan_list:
-                    log(u'I can not add the xmltvID: "%s-sd". It already exists in the input file.\n' % (chanid), 0)
-                    cancel_processing = True
+    def window_only(self):
+        """ Return True if --from or --until is given without channels to process """
+        if self.args.time_from != None or self.args.time_until != None:
+            return len(self.args.id_list) == 0
 
-                if config.args.remove_hd_tags == False and '%s-hd' % (chanid) in self.chan_list:
-                    log(u'I can not add the xmltvID: "%s-hd". It already exists in the input file.\n' % (chanid), 0)
-                    cancel_processing = True
+        return False
 
-        if cancel_processing:
-            log(u'Canceling the processing of: %s\n' % (config.input_file), 0)
-            return False
+    # end window_only()
 
-        return True
+    def init_batch(self):
+        """ Collect the input files of a batch and the output file for each """
+        if (self.args.id_list == None or len(self.args.id_list) == 0) and not self.validate_only() and \
+          not self.window_only():
+            log(u'Please give one or more xmltvID\'s to process\n', 0)
+            return(1)
 
-    # end add_hd_tags()
+        input_files = []
+        for item in self.args.batch:
+            if os.path.isdir(item):
+                names = glob.glob(os.path.join(item, '*.xml'))
+                for ext in compression_extensions.keys():
+                    names.extend(glob.glob(os.path.join(item, '*.xml' + ext)))
 
-    def process_requests(self):
-        for channel in self.channels[:]:
-            chanid = channel['attribs']['id']
-            if chanid in config.args.id_list:
-                programs = self.programs[chanid]
-                if config.args.add_new_id:
-                    # preserve the old listings
-                    log(u'Preserving the old listing for %s\n' % (chanid))
-                    self.create_output(chanid)
+            elif glob.has_magic(item):
+                names = glob.glob(item)
 
-                if config.args.remove_hd_tags == True:
-                    log (u'Removing HDTV tags from %s\n' % (chanid))
-                    self.remove_hd_tags(chanid, programs)
+            else:
+                names = [item]
 
-                    if config.args.add_new_id:
-                        chanid = u'%s-sd' % (chanid)
-                        channel['attribs']['id'] = chanid
+            for name in sorted(names):
+                name = os.path.realpath(name)
+                if not name in input_files:
+                    input_files.append(name)
 
-                    log(u'Creating the new listing for %s\n' % (chanid))
-                    self.create_output(chanid)
+        if len(input_files) == 0:
+            log(u'No xmltv files found to process\n', 0)
+            return(1)
 
-                elif config.args.remove_hd_tags == False:
-                    log (u'Adding HDTV tags to %s\n' % (chanid))
-                    self.add_hd_tags(chanid, programs)
+        out_dir = None
+        if self.args.output_file != None:
+            out_dir = os.path.realpath(self.args.output_file)
+            try:
+                if not os.path.exists(out_dir):
+                    log(u'Creating %s directory,\n' % out_dir)
+                    os.makedirs(out_dir)
 
-                    if config.args.add_new_id:
-                        chanid = u'%s-hd' % (chanid)
-                        channel['attribs']['id'] = chanid
+            except:
+                log(u'Error creating the output directory: %s\n' % (out_dir), 0)
+                return(1)
 
-                    log(u'Creating the new listing for %s\n' % (chanid))
-                    self.create_output(chanid)
+        self.batch_jobs = []
+        for name in input_files:
+            # Keep the compression of the input for the output
+            base_name, ext = os.path.splitext(os.path.basename(name))
+            if not ext.lower() in compression_extensions:
+                base_name, ext = base_name + ext, ''
 
-                elif config.args.remove_hd_tags == None:
-                    continue
+            if base_name.lower().endswith('.xml'):
+                base_name = base_name[:-4]
 
-            else:
-                log(u'Preserving the old listing for %s\n' % (chanid))
-                self.create_output(chanid)
+            self.batch_jobs.append((name, os.path.join(out_dir or os.path.dirname(name), base_name + '.out' + ext)))
 
-    # end process_requests()
+        return
 
-    def remove_hd_tags(self, chanid, programs):
-        prog_list = []
-        t_count = 0
-        for p in programs[:]:
-            if config.args.add_new_id:
-                p['attribs']['channel'] = u'%s-sd' % (chanid)
+    # end init_batch()
 
-            for t in range(len(p['tags'])):
-                if p['tags'][t]['tag'] == 'title':
-                    ptitle = p['tags'][t]['value']['text']
+    def close(self, keep_output = True):
+        """ Close everything. Without keep_output a new output file is thrown away """
+        # close everything neatly
+        self.close_files(keep_output)
+        try:
+            if self.log_output != None:
+                self.log_output.close()
 
-                if p['tags'][t]['tag'] == 'video':
-                    for v in p['tags'][t]['value']['tags']:
-                        if v['tag'] == 'quality' and v['value']['text'].lower() == 'hdtv':
-                            log(u'Removed HDTV tag from %s on xmltvID %s\n' % (ptitle, chanid), 2)
-                            t_count += 1
-                            if len(p['tags'][t]['value']['tags']) == 1:
-                                p['tags'].pop(t)
+        except:
+            pass
 
-                            else:
-                                p['tags'][t]['value']['tags'] .remove(v)
+    # end close()
 
-                            break
+    def close_files(self, keep_output = True):
+        """ Close the input and the output, but keep logging """
+        flush_log()
+        try:
+            if self.input != None:
+                self.input.close()
+                self.input = None
 
-                    prog_list.append(p)
-                    break
+            if self.output == getattr(sys.stdout, 'buffer', sys.stdout):
+                self.output.flush()
 
-            else:
-                prog_list.append(p)
+            elif self.output != None:
+                self.output.close()
 
-        log (u'%s HDTV tags removed from %s\n' % (t_count, chanid))
-        if config.args.add_new_id:
-            self.programs[u'%s-sd' % (chanid)] = prog_list
-            #~ del self.programs[chanid]
+            if self.atomic_output != None:
+                if keep_output:
+                    self.atomic_output.commit()
 
-        else:
-            self.programs[chanid] = prog_list
+                else:
+                    self.atomic_output.discard()
 
-    # end remove_hd_tags()
+                self.atomic_output = None
 
-    def add_hd_tags(self, chanid, programs):
-        prog_list = []
-        t_count = 0
-        for p in programs[:]:
-            if config.args.add_new_id:
-                p['attribs']['channel'] = u'%s-hd' % (chanid)
+            self.output = None
+            flush_log()
 
-            for t in range(len(p['tags'])):
-                if p['tags'][t]['tag'] == 'title':
-                    ptitle = p['tags'][t]['value']['text']
+        except:
+            pass
 
-                if p['tags'][t]['tag'] == 'video':
-                    for v in p['tags'][t]['value']['tags']:
-                        if v['tag'] == 'quality' and v['value']['text'].lower() == 'hdtv':
-                            prog_list.append(p)
-                            break
+    # end close_files()
 
-                    else:
-                        log(u'Added HDTV tag to %s on xmltvID %s\n' % (ptitle, chanid), 2)
-                        t_count += 1
-                        p['tags'][t]['value']['tags'].append({'tag': 'quality',
-                                                                                              'value':{'attribs':{},
-                                                                                                               'text':'HDTV',
-                                                                                                               'tail':'',
-                                                                                                               'tags':[]}})
+    def reopen_files(self):
+        """ Open the input and the output again for the next --watch cycle """
+        self.input = self.open_input(self.input_file)
+        if self.input == None:
+            return(1)
 
-                        prog_list.append(p)
-                        break
+        if self.args.split == None and self.args.export_db == None:
+            self.output = self.open_output(self.output_file)
+            if self.output == None:
+                return(1)
 
-            else:
-                log(u'Added HDTV tag to %s on xmltvID %s\n' % (ptitle, chanid), 2)
-                t_count += 1
-                p['tags'].append({'tag': 'video',
-                                                 'value':{'attribs':{},
-                                                                  'text':'',
-                                                                  'tail':'',
-                                                                  'tags':[{'tag': 'quality',
-                                                                                   'value':{'attribs':{},
-                                                                                                    'text':'HDTV',
-                                                                                                    'tail':'',
-                                                                                                    'tags':[]}}]}})
-
-                prog_list.append(p)
-
-        log (u'%s HDTV tags added to %s\n' % (t_count, chanid))
-        if config.args.add_new_id:
-            self.programs[u'%s-hd' % (chanid)] = prog_list
-            del self.programs[chanid]
+        return
 
-        else:
-            self.programs[chanid] = prog_list
-
-    # end add_hd_tags()
-
-    def create_output(self, chanid = None):
-        def create_tag(name, sdict, ident = 0):
-            out_str = u'%s<%s' % ( ''.rjust(ident), name)
-            # Put some of the attribute in order
-            processed = []
-            for o in config.attrib_order:
-                if ident == o['ident'] and name == o['name']:
-                    for i in range(len(o['values'])):
-                        processed.append(o['values'][i])
-                        for a, v in sdict['attribs'].items():
-                            if a == o['values'][i]:
-                                out_str += u' %s="%s"' % (a, v)
-                                break
+    # end reopen_files()
 
-                    break
+# end Configure
+config = Configure()
 
-            for a, v in sdict['attribs'].items():
-                if not a in processed:
-                    out_str += u' %s="%s"' % (a, v)
+def xmltv_time(value):
+    """
+    Return the xmltv time 'YYYYMMDDhhmmss +zzzz' as seconds since the epoch.
+    Trailing fields may be missing. Without a timezone UTC is assumed.
+    Returns None if the value can not be read.
+    """
+    if value == None:
+        return None
 
-            # Text is None so close the tag immidiately and return
-            if  sdict['text'] == None:
-                return u'%s/>%s\n' % (out_str, sdict['tail'])
+    try:
+        value = value.strip()
+        stamp = value.split(' ', 1)[0]
+        seconds = calendar.timegm((int(stamp[0:4]),
+                                            int(stamp[4:6] or 1),
+                                            int(stamp[6:8] or 1),
+                                            int(stamp[8:10] or 0),
+                                            int(stamp[10:12] or 0),
+                                            int(stamp[12:14] or 0), 0, 0, 0))
+
+        offset = value[len(stamp):].strip()
+        if len(offset) == 5 and offset[0] in '+-':
+            shift = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+            seconds = seconds - shift if offset[0] == '+' else seconds + shift
+
+        return seconds
+
+    except (ValueError, IndexError):
+        return None
+
+# end xmltv_time()
+
+def time_option(value, now = None):
+    """
+    Read a --from or --until value: 'now', an offset from now like
+    '+48h', '-2d' or '+90m', or an xmltv time. Returns seconds since
+    the epoch or None if the value can not be read.
+    """
+    if now == None:
+        now = int(time.time())
+
+    value = value.strip().lower()
+    if value == 'now':
+        return now
+
+    if value[:1] in ('+', '-') and value[-1:] in ('m', 'h', 'd'):
+        try:
+            seconds = int(value[1:-1]) * {'m': 60, 'h': 3600, 'd': 86400}[value[-1]]
 
-            # There are no children so append any text a closing tag, a possible tail and return
-            elif len(sdict['tags']) == 0:
-                return u'%s>%s</%s>%s\n' % (out_str, sdict['text'], name, sdict['tail'])
+        except ValueError:
+            return None
 
-            # We finnish the start tag and add a possible text on a newline
-            elif sdict['text'] == '':
-                out_str += u'>\n'
+        return now + seconds if value[0] == '+' else now - seconds
 
-            else:
-                out_str += u'>\n%s%s\n' % (''.rjust(ident + 2), sdict['text'])
-
-            # We have to put some child tags in the right order
-            processed = []
-            for o in config.tag_order:
-                if ident == o['ident'] and name == o['name']:
-                    for i in range(len(o['values'])):
-                        processed.append(o['values'][i])
-                        #~ for t in range(len(sdict['tags'])-1, -1, -1):
-                           #~ if sdict['tags'][t]['tag'] == o['values'][i]:
-                                #~ out_str += create_tag(sdict['tags'][t]['tag'], sdict['tags'][t]['value'], ident + 2)
-                        for t in sdict['tags']:
-                           if t['tag'] == o['values'][i]:
-                                out_str += create_tag(t['tag'], t['value'], ident + 2)
-                                # With some the same tag can appear more than once so we don't break
+    return xmltv_time(value)
 
+# end time_option()
+
+def shift_xmltv_time(value, seconds):
+    """ Return the xmltv time value moved by seconds, keeping its length and timezone """
+    try:
+        stamp = value.strip().split(' ', 1)[0]
+        moved = datetime.datetime(int(stamp[0:4]),
+                                            int(stamp[4:6] or 1),
+                                            int(stamp[6:8] or 1),
+                                            int(stamp[8:10] or 0),
+                                            int(stamp[10:12] or 0),
+                                            int(stamp[12:14] or 0)) + datetime.timedelta(seconds = seconds)
+
+        return u'%s%s' % (moved.strftime('%Y%m%d%H%M%S')[:len(stamp)], value.strip()[len(stamp):])
+
+    except (ValueError, IndexError, OverflowError):
+        return value
+
+# end shift_xmltv_time()
+
+def escape_text(text):
+    # Most text needs no escaping, so only replace what is there
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+
+    return text
+
+# end escape_text()
+
+def escape_attrib(value):
+    value = escape_text(value)
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+
+    return value
+
+# end escape_attrib()
+
+# Every tag and attribute name is stored only once
+tag_names = {}
+def intern_name(name):
+    return tag_names.setdefault(name, name)
+
+# end intern_name()
+
+# The feature flags of a programme, see programme_features()
+FEATURE_TITLE = 1
+FEATURE_VIDEO = 2
+FEATURE_HDTV = 4
+FEATURE_SDTV = 8
+FEATURE_ASPECT = 16
+feature_names = {'title': FEATURE_TITLE, 'video': FEATURE_VIDEO, 'hdtv': FEATURE_HDTV,
+                'sdtv': FEATURE_SDTV, 'aspect': FEATURE_ASPECT}
+
+def programme_features(programme):
+    """
+    Return the feature flags of a programme. An XMLTV_Node got them
+    when it was parsed, others are scanned for them.
+    """
+    flags = getattr(programme, 'flags', None)
+    if flags != None:
+        return flags
+
+    flags = 0
+    for t in programme:
+        if t.tag == 'title':
+            flags |= FEATURE_TITLE
+
+        elif t.tag == 'video':
+            flags |= FEATURE_VIDEO
+            for v in t:
+                if v.tag == 'aspect':
+                    flags |= FEATURE_ASPECT
+
+                elif v.tag == 'quality' and v.text != None:
+                    quality = v.text.strip().lower()
+                    if quality == 'hdtv':
+                        flags |= FEATURE_HDTV
+
+                    elif quality == 'sdtv':
+                        flags |= FEATURE_SDTV
+
+    if isinstance(programme, XMLTV_Node):
+        programme.flags = flags
+
+    return flags
+
+# end programme_features()
+
+class XMLTV_Node(object):
+    """
+    A compact element of a channel or programme.
+        tag: the interned tag name
+        text: the stripped text behind the starttag or None for an empty tag
+        tail: the stripped text behind the endtag
+        attribs: a tuple of (name, value) pairs in their original order
+        children: a sequence of XMLTV_Node objects
+        flags: on a programme its FEATURE_ flags, set while parsing.
+            An edit of the children sets it to None, which has it found
+            again on the next programme_features(). Edits deeper down,
+            like in the video tag, must update it themselves.
+
+    It offers the part of the ElementTree element interface we use,
+    so most code can handle both.
+    """
+    __slots__ = ('tag', 'text', 'tail', 'attribs', 'children', 'flags')
+
+    def __init__(self, tag, text = None, tail = u'', attribs = (), children = ()):
+        self.tag = intern_name(tag)
+        self.text = text
+        self.tail = tail
+        self.attribs = attribs
+        self.children = children
+        self.flags = None
+
+    # end Init()
+
+    @classmethod
+    def from_element(cls, elem):
+        """ Recursively convert an ElementTree element """
+        node = cls(elem.tag,
+                        None if elem.text == None else elem.text.strip(),
+                        u'' if elem.tail == None else elem.tail.strip())
+
+        if len(elem.attrib) > 0:
+            node.attribs = tuple([(intern_name(a), v) for a, v in elem.attrib.items()])
+
+        if len(elem) > 0:
+            node.children = [cls.from_element(t) for t in elem]
+
+        if node.tag == 'programme':
+            programme_features(node)
+
+        return node
+
+    # end from_element()
+
+    def get(self, name, default = None):
+        for a, v in self.attribs:
+            if a == name:
+                return v
+
+        return default
+
+    # end get()
+
+    def set(self, name, value):
+        attribs = list(self.attribs)
+        for i in range(len(attribs)):
+            if attribs[i][0] == name:
+                attribs[i] = (attribs[i][0], value)
+                break
+
+        else:
+            attribs.append((intern_name(name), value))
+
+        self.attribs = tuple(attribs)
+
+    # end set()
+
+    def items(self):
+        return list(self.attribs)
+
+    # end items()
+
+    def find(self, tag):
+        """ Return the first child with this tag or None """
+        for t in self.children:
+            if t.tag == tag:
+                return t
+
+        return None
+
+    # end find()
+
+    def append(self, child):
+        if not isinstance(self.children, list):
+            self.children = list(self.children)
+
+        self.children.append(child)
+        self.flags = None
+
+    # end append()
+
+    def remove(self, child):
+        if not isinstance(self.children, list):
+            self.children = list(self.children)
+
+        self.children.remove(child)
+        self.flags = None
+
+    # end remove()
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def iter(self):
+        """ Yield this node and all below it in document order """
+        yield self
+        for t in self.children:
+            for n in t.iter():
+                yield n
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getstate__(self):
+        return (self.tag, self.text, self.tail, self.attribs, self.children, self.flags)
+
+    def __setstate__(self, state):
+        self.tag, self.text, self.tail, self.attribs, self.children = state[:5]
+        self.flags = state[5] if len(state) > 5 else None
+        self.tag = intern_name(self.tag)
+
+# end XMLTV_Node
+
+class Prefixed_Reader():
+    """
+    A minimal file-like wrapper that first returns the already read
+    header bytes and then continues reading from the file itself.
+    """
+    def __init__(self, prefix, source):
+        self.prefix = prefix
+        self.source = source
+        self.name = getattr(source, 'name', u'<input>')
+
+    # end Init()
+
+    def read(self, size = -1):
+        if len(self.prefix) == 0:
+            return self.source.read(size)
+
+        if size < 0:
+            data = self.prefix + self.source.read()
+            self.prefix = b''
+            return data
+
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        return data
+
+    # end read()
+
+    def readline(self):
+        if len(self.prefix) == 0:
+            return self.source.readline()
+
+        end = self.prefix.find(b'\n')
+        if end == -1:
+            data = self.prefix + self.source.readline()
+            self.prefix = b''
+            return data
+
+        data = self.prefix[:end + 1]
+        self.prefix = self.prefix[end + 1:]
+        return data
+
+    # end readline()
+
+    def close(self):
+        self.source.close()
+
+    # end close()
+
+# end Prefixed_Reader
+
+# The magic bytes and file extensions of the compression formats we read and write
+compression_magic = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bzip2'), (b'\xfd7zXZ\x00', 'xz'))
+compression_extensions = {'.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz'}
+
+def compression_codec(file_name = None, magic = None):
+    """ Return 'gzip', 'bzip2', 'xz' or None from the first bytes or else the extension """
+    if magic != None:
+        for m, codec in compression_magic:
+            if magic.startswith(m):
+                return codec
+
+        return None
+
+    if file_name != None:
+        return compression_extensions.get(os.path.splitext(file_name)[1].lower())
+
+    return None
+
+# end compression_codec()
+
+class Decompress_Reader():
+    """
+    A file-like wrapper that decompresses a gzip, bzip2 or xz stream while
+    it is read, so no temporary file is needed. Concatenated streams are
+    read as one, like gunzip does.
+    """
+    def __init__(self, source, codec, chunk_size = 65536):
+        self.source = source
+        self.codec = codec
+        self.name = getattr(source, 'name', u'<input>')
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+        self.decompressor = self.new_decompressor()
+
+    # end Init()
+
+    def new_decompressor(self):
+        if self.codec == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        elif self.codec == 'bzip2':
+            return bz2.BZ2Decompressor()
+
+        elif self.codec == 'xz':
+            return lzma.LZMADecompressor()
+
+    # end new_decompressor()
+
+    def fill(self):
+        """ Decompress at least one more chunk, returns False at the end of the stream """
+        out = []
+        while len(out) == 0 and not self.eof:
+            data = self.source.read(self.chunk_size)
+            if len(data) == 0:
+                self.eof = True
+                if self.codec == 'gzip':
+                    out.append(self.decompressor.flush())
+
+                break
+
+            while len(data) > 0:
+                try:
+                    out.append(self.decompressor.decompress(data))
+
+                except EOFError:
+                    # The previous stream ended exactly at the end of a chunk
+                    self.decompressor = self.new_decompressor()
+                    continue
+
+                data = self.decompressor.unused_data
+                if len(data) > 0:
+                    # The next stream is concatenated to this one
+                    self.decompressor = self.new_decompressor()
+
+            out = [d for d in out if len(d) > 0]
+
+        if len(out) == 0:
+            return False
+
+        self.buffer = self.buffer[self.pos:] + b''.join(out)
+        self.pos = 0
+        return True
+
+    # end fill()
+
+    def read(self, size = -1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self.fill():
+                break
+
+        if size < 0:
+            size = len(self.buffer) - self.pos
+
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    # end read()
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b'\n', self.pos)
+            if end != -1:
+                end += 1
+                break
+
+            if not self.fill():
+                end = len(self.buffer)
+                break
+
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+    # end readline()
+
+    def close(self):
+        self.source.close()
+
+    # end close()
+
+# end Decompress_Reader
+
+class Compress_Writer():
+    """
+    A file-like wrapper that compresses everything written to it
+    into a gzip, bzip2 or xz stream on the target file
+    """
+    def __init__(self, target, codec, level = 6):
+        self.target = target
+        self.codec = codec
+        self.name = getattr(target, 'name', u'<output>')
+        if codec == 'gzip':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        elif codec == 'bzip2':
+            self.compressor = bz2.BZ2Compressor(level)
+
+        elif codec == 'xz':
+            self.compressor = lzma.LZMACompressor(preset = level)
+
+    # end Init()
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if len(data) > 0:
+            self.target.write(data)
+
+    # end write()
+
+    def flush(self):
+        # Flushing the compressor would end the stream, so only the target is flushed
+        self.target.flush()
+
+    # end flush()
+
+    def close(self):
+        if self.compressor != None:
+            self.target.write(self.compressor.flush())
+            self.compressor = None
+
+        self.target.close()
+
+    # end close()
+
+# end Compress_Writer
+
+class Channel_Cache():
+    """
+    A directory with the rendered programmes of earlier runs. Every channel
+    job is stored in its own file, named after a hash of the input
+    programmes of the channel and the requested operation. When the cache
+    grows over max_size bytes the least recently used files are removed.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    # end Init()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '%s.xml' % key)
+
+    # end path()
+
+    def read(self, key):
+        """ Return the cached text for key or None """
+        try:
+            f = io.open(self.path(key), mode = 'rb')
+            try:
+                text = f.read().decode('utf-8')
+
+            finally:
+                f.close()
+
+            # Mark it as recently used
+            os.utime(self.path(key), None)
+            self.hits += 1
+            return text
+
+        except (IOError, OSError):
+            return None
+
+    # end read()
+
+    def open_entry(self, key):
+        """ Return a Cache_Entry to write the text for key to """
+        self.misses += 1
+        try:
+            return Cache_Entry(self.cache_dir, self.path(key))
+
+        except (IOError, OSError):
+            return None
+
+    # end open_entry()
+
+    def evict(self):
+        """ Remove the least recently used files until the cache fits in max_size """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.xml'):
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        removed = 0
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+
+            except OSError:
+                pass
+
+            total -= size
+
+        return removed
+
+    # end evict()
+
+# end Channel_Cache
+
+class Cache_Entry():
+    """
+    Collect the text for one cache file in a temporary file that
+    only replaces the real one when it is complete
+    """
+    def __init__(self, cache_dir, path):
+        self.path = path
+        handle, self.temp_path = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+        self.output = os.fdopen(handle, 'wb')
+
+    # end Init()
+
+    def write(self, text):
+        self.output.write(text.encode('utf-8'))
+
+    # end write()
+
+    def close(self):
+        self.output.close()
+        replace_file(self.temp_path, self.path)
+
+    # end close()
+
+    def discard(self):
+        self.output.close()
+        os.remove(self.temp_path)
+
+    # end discard()
+
+# end Cache_Entry
+
+class Atomic_Output():
+    """
+    A binary output that is written to a temporary file beside file_name.
+    Only commit() puts it in place, so readers of file_name never see it
+    half written. With skip_unchanged an output with the same sha1 as the
+    existing file is dropped instead, with do_fsync it is synced first.
+    """
+    def __init__(self, file_name, skip_unchanged = False, do_fsync = False):
+        self.file_name = file_name
+        self.do_fsync = do_fsync
+        self.digest = hashlib.sha1() if skip_unchanged and os.path.exists(file_name) else None
+        handle, self.temp_path = temp_file(file_name, '.%s.' % os.path.basename(file_name))
+        self.output = os.fdopen(handle, 'wb')
+
+    # end Init()
+
+    def write(self, data):
+        if self.digest != None:
+            self.digest.update(data)
+
+        self.output.write(data)
+
+    # end write()
+
+    def flush(self):
+        self.output.flush()
+
+    # end flush()
+
+    def close(self):
+        if not self.output.closed:
+            self.output.flush()
+            if self.do_fsync:
+                os.fsync(self.output.fileno())
+
+            self.output.close()
+
+    # end close()
+
+    def commit(self):
+        """ Replace file_name with the new output, unless it is the same """
+        self.close()
+        if self.digest != None and os.path.exists(self.file_name) and \
+          file_digest(self.file_name) == self.digest.hexdigest():
+            os.remove(self.temp_path)
+            log(u'%s is unchanged and not rewritten\n' % self.file_name)
+            return
+
+        replace_file(self.temp_path, self.file_name)
+        if self.do_fsync and hasattr(os, 'O_DIRECTORY'):
+            # and the rename
+            handle = os.open(os.path.dirname(self.file_name), os.O_RDONLY | os.O_DIRECTORY)
+            os.fsync(handle)
+            os.close(handle)
+
+    # end commit()
+
+    def discard(self):
+        self.close()
+        os.remove(self.temp_path)
+
+    # end discard()
+
+# end Atomic_Output
+
+# mkstemp creates files only we can read, the files we publish get the usual mode
+file_umask = os.umask(0)
+os.umask(file_umask)
+
+def temp_file(target, prefix):
+    """ Return (handle, path) of a new temporary file beside target with the mode of a new file """
+    handle, temp_path = tempfile.mkstemp(prefix = prefix, dir = os.path.dirname(os.path.realpath(target)))
+    try:
+        os.chmod(temp_path, 0o666 & ~file_umask)
+
+    except OSError:
+        pass
+
+    return (handle, temp_path)
+
+# end temp_file()
+
+def replace_file(source, target):
+    """ Rename source to target, replacing target. Windows needs it removed first """
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+
+    os.rename(source, target)
+
+# end replace_file()
+
+# Raise this when the snapshot layout changes
+snapshot_format = 1
+
+def file_digest(file_name):
+    """ Return the sha1 of a file """
+    digest = hashlib.sha1()
+    source = io.open(file_name, 'rb')
+    while True:
+        data = source.read(1048576)
+        if len(data) == 0:
+            break
+
+        digest.update(data)
+
+    source.close()
+    return digest.hexdigest()
+
+# end file_digest()
+
+def snapshot_encode(node, names):
+    """
+    Return a node, or a parsed element, as nested tuples marshal can store.
+    Tag and attribute names are replaced by their number in names.
+    """
+    tag = names.setdefault(node.tag, len(names))
+    attribs = tuple([(names.setdefault(a, len(names)), v) for a, v in node.items()])
+    children = tuple([snapshot_encode(t, names) for t in node])
+    text = None if node.text == None else node.text.strip()
+    tail = u'' if node.tail == None else node.tail.strip()
+    return (tag, text, tail, attribs, children, getattr(node, 'flags', None))
+
+# end snapshot_encode()
+
+def snapshot_decode(data, names):
+    """ Return the XMLTV_Node stored by snapshot_encode """
+    node = XMLTV_Node.__new__(XMLTV_Node)
+    node.tag = names[data[0]]
+    node.text = data[1]
+    node.tail = data[2]
+    node.attribs = tuple([(names[a], v) for a, v in data[3]]) if len(data[3]) > 0 else ()
+    node.children = [snapshot_decode(t, names) for t in data[4]] if len(data[4]) > 0 else ()
+    node.flags = data[5]
+    if node.tag == 'programme' and node.flags == None:
+        programme_features(node)
+
+    return node
+
+# end snapshot_decode()
+
+def shard_name(chanid):
+    """ Return a safe file name for the --split file of chanid """
+    return u''.join([c if c.isalnum() or c in u'.-_@' else u'_' for c in chanid]) + u'.xml'
+
+# end shard_name()
+
+class Shard_Writer():
+    """
+    Write the --split files from a bounded queue with a few threads.
+    A file is only written if its sha1 differs from the one in the
+    SHA1SUMS file of the last run, to a temporary name that is then
+    renamed. After a complete run without errors, files of the last run
+    that are not written again are removed.
+    """
+    def __init__(self, out_dir, threads = 4):
+        self.out_dir = out_dir
+        self.old_sums = self.read_sums()
+        self.sums = {}
+        self.errors = []
+        self.written = 0
+        self.unchanged = 0
+        self.lock = threading.Lock()
+        threads = max(1, threads)
+        self.queue = queue.Queue(2 * threads)
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target = self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    # end Init()
+
+    def read_sums(self):
+        sums = {}
+        try:
+            sums_file = io.open(os.path.join(self.out_dir, 'SHA1SUMS'), 'r', encoding = 'utf-8')
+            for line in sums_file:
+                parts = line.rstrip(u'\n').split(u'  ', 1)
+                if len(parts) == 2:
+                    sums[parts[1]] = parts[0]
+
+            sums_file.close()
+
+        except IOError:
+            pass
+
+        return sums
+
+    # end read_sums()
+
+    def put(self, name, text):
+        """ Queue a file, waiting when the writers are behind """
+        self.queue.put((name, text))
+
+    # end put()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job == None:
+                break
+
+            name, text = job
+            try:
+                data = text.encode(config.file_encoding)
+                digest = hashlib.sha1(data).hexdigest()
+                path = os.path.join(self.out_dir, name)
+                changed = self.old_sums.get(name) != digest or not os.path.exists(path)
+                if changed:
+                    handle, temp_path = temp_file(path, '.%s.' % name)
+                    target = os.fdopen(handle, 'wb')
+                    target.write(data)
+                    target.close()
+                    replace_file(temp_path, path)
+
+                with self.lock:
+                    self.sums[name] = digest
+                    if changed:
+                        self.written += 1
+
+                    else:
+                        self.unchanged += 1
+
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(u'%s: %s' % (name, e))
+
+    # end run()
+
+    def close(self, complete = True):
+        """
+        Wait for the writers. Only if complete and without errors remove
+        the old files and save the sums, else leave them as they were.
+        """
+        for t in self.threads:
+            self.queue.put(None)
+
+        for t in self.threads:
+            t.join()
+
+        if not complete or len(self.errors) > 0:
+            return 0
+
+        removed = 0
+        for name in self.old_sums.keys():
+            if not name in self.sums:
+                try:
+                    os.remove(os.path.join(self.out_dir, name))
+                    removed += 1
+
+                except OSError:
+                    pass
+
+        try:
+            sums_file = io.open(os.path.join(self.out_dir, 'SHA1SUMS'), 'w', encoding = 'utf-8')
+            for name in sorted(self.sums.keys()):
+                sums_file.write(u'%s  %s\n' % (self.sums[name], name))
+
+            sums_file.close()
+
+        except IOError as e:
+            self.errors.append(u'SHA1SUMS: %s' % e.strerror)
+
+        return removed
+
+    # end close()
+
+# end Shard_Writer
+
+# CPU time of this process, time.clock is wall time on Windows
+cpu_time = getattr(time, 'process_time', time.clock if os.name != 'nt' else lambda: sum(os.times()[:2]))
+
+class Phase_Timer():
+    """
+    Collect the wall and CPU time and an element count per phase for
+    --profile. A phase can be timed in one go or in many small parts
+    by passing the mark() taken at its start to add().
+    """
+    phase_order = ('parse', 'convert', 'check', 'transform', 'serialize', 'write', 'workers')
+
+    def __init__(self):
+        self.phases = {}
+        self.started = self.mark()
+
+    # end Init()
+
+    def mark(self):
+        return (time.time(), cpu_time())
+
+    # end mark()
+
+    def add(self, phase, mark, count = 0):
+        """ Add the time since mark to phase and return a new mark """
+        now = self.mark()
+        if not phase in self.phases:
+            self.phases[phase] = [0.0, 0.0, 0]
+
+        self.phases[phase][0] += now[0] - mark[0]
+        self.phases[phase][1] += now[1] - mark[1]
+        self.phases[phase][2] += count
+        return now
+
+    # end add()
+
+    def subtract(self, phase, inner):
+        """ Take the time of inner out of phase, when it was measured within it """
+        if phase in self.phases and inner in self.phases:
+            self.phases[phase][0] -= self.phases[inner][0]
+            self.phases[phase][1] -= self.phases[inner][1]
+
+    # end subtract()
+
+    def report(self):
+        """ Write the phases with their share of the total to the log file """
+        wall, cpu = [n - s for n, s in zip(self.mark(), self.started)]
+        log(u'profile: phase=total wall=%.3f cpu=%.3f\n' % (wall, cpu), 1, 2)
+        for phase in self.phase_order:
+            if phase in self.phases:
+                p_wall, p_cpu, count = self.phases[phase]
+                log(u'profile: phase=%s wall=%.3f cpu=%.3f share=%.1f%% count=%s rate=%.0f/s\n' % \
+                        (phase, p_wall, p_cpu, 100 * p_wall / max(wall, 0.000001), count, count / max(p_wall, 0.000001)), 1, 2)
+
+    # end report()
+
+# end Phase_Timer
+
+class XMLTV_Writer():
+    """
+    Render the channel and programme tags and write them to a binary
+    output stream as soon as they are created. The rendered text is
+    collected up to buffer_size characters before it is encoded and
+    written, so the output never has to be held in memory as a whole.
+    """
+    def __init__(self, output, encoding = None, buffer_size = None):
+        self.output = output
+        self.encoding = config.file_encoding if encoding == None else encoding
+        self.buffer_size = config.buffer_size if buffer_size == None else buffer_size
+        self.buffer = []
+        self.buffer_len = 0
+
+    # end Init()
+
+    def create_tag(self, node, ident = 0):
+        """
+        Render an XMLTV_Node or a parsed element with its children.
+        Text and tail of a parsed element are not yet stripped.
+        """
+        name = node.tag
+        indent = u' ' * ident
+        out_str = u'%s<%s' % (indent, name)
+        # Put some of the attribute in order, the others follow in their original order
+        attribs = node.items()
+        rank = config.attrib_rank.get((name, ident))
+        if rank != None and len(attribs) > 1:
+            last = len(rank)
+            attribs.sort(key = lambda a: rank.get(a[0], last))
+
+        for a, v in attribs:
+            out_str += u' %s="%s"' % (a, escape_attrib(v))
+
+        text = None if node.text == None else node.text.strip()
+        tail = u'' if node.tail == None else escape_text(node.tail.strip())
+        # Text is None so close the tag immidiately and return
+        if  text == None:
+            return u'%s/>%s\n' % (out_str, tail)
+
+        # There are no children so append any text a closing tag, a possible tail and return
+        elif len(node) == 0:
+            return u'%s>%s</%s>%s\n' % (out_str, escape_text(text), name, tail)
+
+        # We finnish the start tag and add a possible text on a newline
+        elif text == '':
+            out_str += u'>\n'
+
+        else:
+            out_str += u'>\n%s  %s\n' % (indent, escape_text(text))
+
+        # We have to put some child tags in the right order. The sort is stable so
+        # repeated tags and the not ranked ones keep their order
+        tags = list(node)
+        rank = config.tag_rank.get((name, ident))
+        if rank != None and len(tags) > 1:
+            last = len(rank)
+            tags.sort(key = lambda t: rank.get(t.tag, last))
+
+        for t in tags:
+            out_str += self.create_tag(t, ident + 2)
+
+        # close the tag and return
+        return u'%s%s</%s>\n' % (out_str, indent, name)
+
+    # end create_tag()
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffer_len += len(text)
+        if self.buffer_len >= self.buffer_size:
+            self.flush()
+
+    # end write()
+
+    def write_tag(self, node, ident = 2):
+        self.write(self.create_tag(node, ident))
+
+    # end write_tag()
+
+    def write_header(self, header):
+        # Write the header straight away so the output file is started
+        self.write(header)
+        self.flush()
+
+    # end write_header()
+
+    def write_footer(self):
+        self.write(u'</tv>\n')
+        self.flush()
+
+    # end write_footer()
+
+    def flush(self):
+        if self.buffer_len > 0:
+            if config.profile != None:
+                mark = config.profile.mark()
+
+            self.output.write(u''.join(self.buffer).encode(self.encoding))
+            if config.profile != None:
+                # counted in characters
+                config.profile.add('write', mark, self.buffer_len)
+
+            self.buffer = []
+            self.buffer_len = 0
+
+    # end flush()
+
+# end XMLTV_Writer
+
+def programme_title(programme):
+    title = programme.find('title')
+    return None if title == None else title.text
+
+# end programme_title()
+
+class Operation(object):
+    """
+    The base of the edits that can be chained with --operation.
+    All operations on a channel are applied to each programme in one pass.
+        new_id(chanid): the xmltvID after the edit, None drops the channel
+        start(chanid): called before the first programme of a channel
+        apply(programme, chanid): returns the edited programme or None to drop it
+        finish(chanid): called after the last programme of a channel
+    Per programme messages go through edited() and summary(), which
+    only do any work if log level 2 or 4 is set.
+    To add an operation, subclass it and add it to the operations dict.
+    """
+    name = ''
+    needs_argument = False
+
+    def __init__(self, argument = None):
+        if self.needs_argument and argument in (None, ''):
+            raise ValueError(u'The operation "%s" needs an argument' % self.name)
+
+        self.argument = argument
+        self.count = 0
+
+    # end Init()
+
+    def describe(self):
+        return self.name if self.argument == None else u'%s=%s' % (self.name, self.argument)
+
+    def new_id(self, chanid):
+        return chanid
+
+    def start(self, chanid):
+        self.count = 0
+        # Decided once per channel, so the programmes only test a flag
+        self.details = log_enabled(2)
+        self.titles = [] if log_enabled(4) else None
+
+    def apply(self, programme, chanid):
+        return programme
+
+    def finish(self, chanid):
+        pass
+
+    def edited(self, programme, message, chanid):
+        """ Log message on level 2 and collect the title for summary """
+        if self.details:
+            log(message, 2, args = (programme_title(programme), chanid))
+
+        if self.titles != None:
+            self.titles.append(programme_title(programme) or u'')
+
+    def summary(self, message, chanid):
+        """ Log the collected titles in one line on level 4 """
+        if self.titles != None and len(self.titles) > 0:
+            log(message, 4, args = (chanid, u', '.join(self.titles)))
+            self.titles = None
+
+# end Operation
+
+class Remove_HD_Tags(Operation):
+    """ Remove the HDTV video quality """
+    name = 'remove-hd'
+
+    def start(self, chanid):
+        Operation.start(self, chanid)
+        log (u'Removing HDTV tags from %s\n' % (chanid))
+
+    def apply(self, programme, chanid):
+        flags = programme_features(programme)
+        if not flags & FEATURE_HDTV:
+            return programme
+
+        video = programme.find('video')
+        quality = None
+        for v in video:
+            if v.tag == 'quality' and v.text != None and v.text.strip().lower() == 'hdtv':
+                quality = v
+                break
+
+        if len(video) == 1:
+            programme.remove(video)
+            flags &= ~(FEATURE_VIDEO | FEATURE_HDTV)
+
+        else:
+            video.remove(quality)
+            flags &= ~FEATURE_HDTV
+
+        if isinstance(programme, XMLTV_Node):
+            programme.flags = flags
+
+        self.edited(programme, u'Removed HDTV tag from %s on xmltvID %s\n', chanid)
+        self.count += 1
+        return programme
+
+    def finish(self, chanid):
+        log (u'%s HDTV tags removed from %s\n' % (self.count, chanid))
+        self.summary(u'Removed HDTV tags on %s from: %s\n', chanid)
+
+# end Remove_HD_Tags
+
+class Add_HD_Tags(Operation):
+    """ Give every programme a HDTV video quality """
+    name = 'add-hd'
+
+    def start(self, chanid):
+        Operation.start(self, chanid)
+        log (u'Adding HDTV tags to %s\n' % (chanid))
+
+    def apply(self, programme, chanid):
+        flags = programme_features(programme)
+        if flags & FEATURE_HDTV:
+            return programme
+
+        if flags & FEATURE_VIDEO:
+            programme.find('video').append(XMLTV_Node('quality', u'HDTV'))
+
+        else:
+            programme.append(XMLTV_Node('video', u'', children = [XMLTV_Node('quality', u'HDTV')]))
+
+        if isinstance(programme, XMLTV_Node):
+            programme.flags = flags | FEATURE_VIDEO | FEATURE_HDTV
+
+        self.edited(programme, u'Added HDTV tag to %s on xmltvID %s\n', chanid)
+        self.count += 1
+        return programme
+
+    def finish(self, chanid):
+        log (u'%s HDTV tags added to %s\n' % (self.count, chanid))
+        self.summary(u'Added HDTV tags on %s to: %s\n', chanid)
+
+# end Add_HD_Tags
+
+class Rename_ID(Operation):
+    """ Give the channel a new xmltvID. A '%s' in the argument is replaced by the old one """
+    name = 'rename'
+    needs_argument = True
+
+    def new_id(self, chanid):
+        return self.argument.replace(u'%s', chanid)
+
+# end Rename_ID
+
+class Drop_Channel(Operation):
+    """ Leave the channel out of the output """
+    name = 'drop'
+
+    def new_id(self, chanid):
+        return None
+
+    def apply(self, programme, chanid):
+        return None
+
+# end Drop_Channel
+
+class Time_Shift(Operation):
+    """ Move the start and stop times of all programmes by a number of minutes """
+    name = 'shift'
+    needs_argument = True
+
+    def __init__(self, argument = None):
+        Operation.__init__(self, argument)
+        try:
+            self.seconds = int(argument) * 60
+
+        except ValueError:
+            raise ValueError(u'The operation "shift" needs a number of minutes, not "%s"' % argument)
+
+    def apply(self, programme, chanid):
+        for attrib in ('start', 'stop'):
+            value = programme.get(attrib)
+            if value != None:
+                programme.set(attrib, shift_xmltv_time(value, self.seconds))
+
+        self.count += 1
+        return programme
+
+    def finish(self, chanid):
+        log (u'Shifted %s programmes on %s by %s minutes\n' % (self.count, chanid, self.argument))
+
+# end Time_Shift
+
+# The operations available to --operation
+operations = {}
+for op_class in (Remove_HD_Tags, Add_HD_Tags, Rename_ID, Drop_Channel, Time_Shift):
+    operations[op_class.name] = op_class
+
+def open_parser(source):
+    """
+    Read the header lines up to the <tv> tag from source and return it
+    with an incremental parser that starts again at the beginning
+    """
+    header = u''
+    header_bytes = []
+    while True:
+        byteline = source.readline()
+        if byteline == b'':
+            break
+
+        header_bytes.append(byteline)
+        line = config.get_line(source, byteline)
+        if line == False:
+            continue
+
+        header += u'%s\n' % line
+        if line[0:3] == '<tv':
+            break
+
+    source = Prefixed_Reader(b''.join(header_bytes), source)
+    return (header, ET.iterparse(source, events = ('start', 'end')))
+
+# end open_parser()
+
+class Process_XML():
+    def __init__(self, edit_ids = None, cache = None, keep_ids = None):
+        self.channels = []
+        self.chan_list = []
+        # The index: xmltvID -> channel and xmltvID -> programmes in document order
+        self.channel_index = {}
+        self.programs = {}
+        # Built on demand: xmltvID -> (sorted start times, programmes in that order)
+        self.time_index = {}
+        # With a time window the start times read while parsing: xmltvID -> array
+        self.start_times = {}
+        self.skipped = 0
+        # Only the channels in edit_ids are converted to XMLTV_Node objects.
+        # The others are kept as parsed elements and written straight from them.
+        # With None all channels are converted.
+        self.edit_ids = None if edit_ids == None else set(edit_ids)
+        # With keep_ids all other channels and their programmes are skipped while parsing
+        self.keep_ids = None if keep_ids == None else set(keep_ids)
+        self.skipped_channels = 0
+        self.skipped_programmes = 0
+        # With a Channel_Cache we keep a hash of the programmes of every channel
+        self.cache = cache
+        self.channel_hashes = {}
+        # With --snapshot process_xml collects everything here as (channels, programmes)
+        self.snapshot = None
+        # With stream set, the output is written while parsing. Once the first
+        # programme is read, job_index holds xmltvID -> channel job and next_job
+        # the job whose programmes are coming in
+        self.stream = False
+        self.job_index = None
+        self.next_job = 0
+        self.late_jobs = set()
+        self.programme_count = 0
+        self.writer = XMLTV_Writer(config.output)
+    # end Init()
+
+    def read_input(self):
+        """
+        Read the header and set up an incremental parser on the input.
+        The file is not read into memory. The parser pulls it in chunks
+        while process_xml handles the channels and programmes one by one.
+        """
+        try:
+            self.output_header, self.et_object = open_parser(config.input)
+
+        except:
+            log(u'error: %s parsing %s\n' % (sys.exc_info()[1], config.input), 0)
+            return 2
+
+    # end read_input()
+
+    def process_xml(self):
+        """
+        Every channel and programme in edit_ids becomes an XMLTV_Node.
+        They are converted as soon as the parser has read their endtag
+        and are then detached from the tree. All other channels and
+        programmes are only passed through, so they are kept as the
+        parsed element without a copy.
+        With stream set, the programmes of channels that are not edited
+        are written as soon as they are read, and an edited channel is
+        kept only until its programmes are done. With the usual layout,
+        programmes grouped per channel in channel order, memory then no
+        longer grows with the guide. Otherwise everything stays in
+        self.programs until process_requests writes it.
+        """
+        root = None
+        try:
+            for event, elem in self.et_object:
+                if root == None:
+                    # The first event is the start of the <tv> tag
+                    root = elem
+                    continue
+
+                if event != 'end':
+                    continue
+
+                if elem.tag == 'channel':
+                    if self.snapshot != None:
+                        elem = XMLTV_Node.from_element(elem)
+                        self.snapshot[0].append(elem)
+
+                    self.add_channel(elem)
+
+                elif elem.tag == 'programme':
+                    if self.stream and self.job_index == None and not self.start_stream():
+                        return 1
+
+                    if self.snapshot != None:
+                        elem = XMLTV_Node.from_element(elem)
+                        self.snapshot[1].append(elem)
+
+                    self.add_programme(elem)
+
+                else:
+                    continue
+
+                # Drop the element from the tree
+                root.clear()
+
+        except:
+            log(u'error: %s parsing %s\n' % (sys.exc_info()[1], config.input_file), 0)
+            return 2
+
+        if self.stream and self.job_index == None and not self.start_stream():
+            return 1
+
+        self.log_skipped()
+
+    # end process_xml()
+
+    def add_channel(self, elem):
+        """ Add a parsed channel to the index, unless it is not asked for """
+        c_id = elem.get('id')
+        if self.keep_ids != None and not c_id in self.keep_ids:
+            self.skipped_channels += 1
+
+        elif c_id != None and c_id != '':
+            channel = self.materialize(c_id, elem)
+            self.chan_list.append(c_id)
+            self.channels.append(channel)
+            self.channel_index[c_id] = channel
+            if not c_id in self.programs:
+                self.programs[c_id] = []
+
+            if self.job_index != None:
+                self.add_late_channel(channel)
+
+    # end add_channel()
+
+    def add_programme(self, elem):
+        """ Add a parsed programme to its channel, unless it is filtered out """
+        c_id = elem.get('channel')
+        if self.keep_ids != None and not c_id in self.keep_ids:
+            self.skipped_programmes += 1
+
+        elif c_id != None and c_id != '':
+            if not c_id in self.programs:
+                self.programs[c_id] = []
+
+            if (config.time_from != None or config.time_until != None) and \
+              not self.in_window(c_id, elem):
+                # Forget it before anything is made of it
+                self.skipped += 1
+                return
+
+            if self.cache != None:
+                self.hash_programme(c_id, elem)
+
+            self.programme_count += 1
+            if self.job_index != None:
+                self.stream_programme(c_id, elem)
+
+            else:
+                self.programs[c_id].append(self.materialize(c_id, elem))
+
+    # end add_programme()
+
+    def start_stream(self):
+        """ Write the header and the channels when the first programme is read """
+        if not self.check_chanids():
+            return False
+
+        self.make_channel_jobs()
+        self.write_channels()
+        self.job_index = {}
+        for index in range(len(self.channel_jobs)):
+            self.job_index[self.channel_jobs[index][0].get('id')] = index
+
+        return True
+
+    # end start_stream()
+
+    def add_late_channel(self, channel):
+        """ Write a channel read after the programmes have started where it is """
+        chanid = channel.get('id')
+        log(u'The channel tag of %s comes after the first programme\n' % (chanid))
+        listings = self.channel_listings(chanid)
+        if len(listings) > 0:
+            self.job_index[chanid] = len(self.channel_jobs)
+            self.channel_jobs.append((channel, listings))
+            self.write_channel(channel, listings)
+
+    # end add_late_channel()
+
+    def stream_programme(self, chanid, elem):
+        """
+        Write a programme of a channel that is not edited right away, or
+        keep it until the programmes of its channel are done. Those of a
+        channel that is not written, are not kept.
+        """
+        index = self.job_index.get(chanid)
+        if index == None:
+            return
+
+        if index < self.next_job:
+            # Its channel is already written, so these come last
+            self.late_jobs.add(index)
+
+        else:
+            while self.next_job < index:
+                self.finish_job(self.next_job)
+                self.next_job += 1
+
+            if self.channel_jobs[index][1] == [(chanid, chanid, None)]:
+                self.writer.write(self.writer.create_tag(elem, 2))
+                return
+
+        self.programs[chanid].append(self.materialize(chanid, elem))
+
+    # end stream_programme()
+
+    def finish_job(self, index):
+        """ Write what is kept for a channel job and forget it """
+        chanid = self.channel_jobs[index][0].get('id')
+        self.render_channel(index, self.writer.write)
+        self.programs[chanid] = []
+        for index_dict in (self.time_index, self.start_times):
+            if chanid in index_dict:
+                del index_dict[chanid]
+
+    # end finish_job()
+
+    def log_skipped(self):
+        if self.keep_ids != None:
+            log(u'Skipped %s channels and %s programmes not asked for\n' % (self.skipped_channels, self.skipped_programmes))
+
+        if config.time_from != None or config.time_until != None:
+            log(u'Skipped %s programmes outside the requested time window\n' % (self.skipped))
+
+    # end log_skipped()
+
+    def load_snapshot(self, path):
+        """
+        Load the channels and programmes from a snapshot made by save_snapshot
+        and run them through the filters. Returns True if it is loaded, False
+        if there is none or it is not made from the current input.
+        """
+        try:
+            # marshal needs a real file object
+            snapshot = open(path, 'rb')
+
+        except IOError:
+            return False
+
+        try:
+            try:
+                meta = marshal.load(snapshot)
+                if meta[0] != snapshot_format or meta[1] != config.input_file:
+                    return False
+
+                stat = os.stat(config.input_file)
+                if meta[3] != stat.st_size:
+                    return False
+
+                if meta[2] != stat.st_mtime and meta[4] != file_digest(config.input_file):
+                    return False
+
+                self.output_header, names, channels, programmes = marshal.load(snapshot)
+
+            except (EOFError, ValueError, TypeError, IndexError):
+                log(u'The snapshot %s is not readable, parsing the input\n' % path)
+                return False
+
+        finally:
+            snapshot.close()
+
+        names = [intern_name(n) for n in names]
+        for c in channels:
+            self.add_channel(snapshot_decode(c, names))
+
+        for p in programmes:
+            self.add_programme(snapshot_decode(p, names))
+
+        log(u'Loaded %s channels and %s programmes from the snapshot %s\n' % (len(channels), len(programmes), path))
+        self.log_skipped()
+        return True
+
+    # end load_snapshot()
+
+    def save_snapshot(self, path):
+        """ Save the channels and programmes collected by process_xml in self.snapshot """
+        channels, programmes = self.snapshot
+        self.snapshot = None
+        names = {}
+        try:
+            stat = os.stat(config.input_file)
+            meta = (snapshot_format, config.input_file, stat.st_mtime, stat.st_size, file_digest(config.input_file))
+            data = (self.output_header, [], [snapshot_encode(c, names) for c in channels], [snapshot_encode(p, names) for p in programmes])
+            data[1].extend(sorted(names.keys(), key = lambda n: names[n]))
+            handle, temp_path = temp_file(path, '.snapshot.')
+            snapshot = os.fdopen(handle, 'wb')
+            marshal.dump(meta, snapshot)
+            marshal.dump(data, snapshot)
+            snapshot.close()
+            replace_file(temp_path, path)
+
+        except (IOError, OSError, ValueError) as e:
+            log(u'Error saving the snapshot %s: %s\n' % (path, e), 0)
+            return
+
+        log(u'Saved %s channels and %s programmes in the snapshot %s\n' % (len(channels), len(programmes), path))
+
+    # end save_snapshot()
+
+    def in_window(self, chanid, elem):
+        """
+        Check if a programme runs inside the --from/--until window and if so
+        keep its start time. Programmes without a readable start are kept.
+        """
+        start = xmltv_time(elem.get('start'))
+        if start != None:
+            stop = xmltv_time(elem.get('stop'))
+            if stop == None:
+                stop = start
+
+            if config.time_from != None and start < config.time_from and stop <= config.time_from:
+                return False
+
+            if config.time_until != None and start >= config.time_until:
+                return False
+
+        if not chanid in self.start_times:
+            self.start_times[chanid] = array.array('l')
+
+        self.start_times[chanid].append(-1 if start == None else start)
+        return True
+
+    # end in_window()
+
+    def hash_programme(self, chanid, elem):
+        """ Add a parsed programme element to the hash of its channel """
+        if not chanid in self.channel_hashes:
+            self.channel_hashes[chanid] = hashlib.sha1()
+
+        parts = []
+        for e in elem.iter():
+            # Stripped, so a parsed element and an XMLTV_Node give the same hash
+            parts.extend((e.tag, (e.text or u'').strip(), (e.tail or u'').strip(), unicode(len(e))))
+            for a in e.items():
+                parts.extend(a)
+
+        self.channel_hashes[chanid].update(u'\x00'.join(parts).encode('utf-8') + b'\x01')
+
+    # end hash_programme()
+
+    def cache_key(self, index):
+        """ Return the cache key for a channel job from its programmes and its listings """
+        channel, listings = self.channel_jobs[index]
+        chanid = channel.get('id')
+        digest = hashlib.sha1(config.version(True).encode('utf-8'))
+        # The operations only matter for a channel they are run on
+        ops = []
+        for old_id, newid, action in listings:
+            if action != None:
+                ops = [op.describe() for op in config.operations]
+
+        digest.update(repr((config.tag_order, config.attrib_order, ops, listings, config.args.repair)).encode('utf-8'))
+        if chanid in self.channel_hashes:
+            digest.update(self.channel_hashes[chanid].digest())
+
+        return digest.hexdigest()
+
+    # end cache_key()
+
+    def materialize(self, chanid, elem):
+        """ Return an editable XMLTV_Node if chanid is to be edited, else the element itself """
+        if isinstance(elem, XMLTV_Node):
+            return elem
+
+        if self.edit_ids == None or chanid in self.edit_ids:
+            if config.profile != None:
+                mark = config.profile.mark()
+                node = XMLTV_Node.from_element(elem)
+                config.profile.add('convert', mark, 1)
+                return node
+
+            return XMLTV_Node.from_element(elem)
+
+        return elem
+
+    # end materialize()
+
+    def get_channel(self, chanid):
+        """ Return the channel with this xmltvID or None """
+        return self.channel_index.get(chanid)
+
+    # end get_channel()
+
+    def get_programmes(self, chanid, start = None, stop = None, by_time = False):
+        """
+        Return the programmes of chanid. Without start and stop in document
+        order, unless by_time is set. With start and/or stop (seconds since
+        the epoch) the programmes running in that window sorted by time.
+        """
+        if not chanid in self.programs:
+            return []
+
+        if start == None and stop == None and not by_time:
+            return self.programs[chanid]
+
+        starts, programmes = self.sorted_programmes(chanid)
+        first = 0
+        last = len(starts)
+        if start != None:
+            first = bisect.bisect_left(starts, start)
+            # The one before may still be running
+            if first > 0:
+                p_stop = xmltv_time(programmes[first - 1].get('stop'))
+                if p_stop == None and first < len(starts):
+                    p_stop = starts[first]
+
+                if p_stop != None and p_stop > start:
+                    first -= 1
+
+        if stop != None:
+            last = bisect.bisect_left(starts, stop)
+
+        return programmes[first:last]
+
+    # end get_programmes()
+
+    def sorted_programmes(self, chanid):
+        """ Return and cache the start times and programmes of chanid sorted by start """
+        if not chanid in self.time_index:
+            keyed = []
+            programmes = self.programs.get(chanid, [])
+            starts = self.start_times.get(chanid)
+            if starts == None or len(starts) != len(programmes):
+                starts = [xmltv_time(p.get('start')) for p in programmes]
+
+            for i in range(len(programmes)):
+                if starts[i] != None and starts[i] != -1:
+                    keyed.append((starts[i], programmes[i]))
+
+            # The programmes are mostly in order already so this is cheap
+            keyed.sort(key = lambda k: k[0])
+            self.time_index[chanid] = ([k[0] for k in keyed], [k[1] for k in keyed])
+
+        return self.time_index[chanid]
+
+    # end sorted_programmes()
+
+    def set_programmes(self, chanid, programmes):
+        """ Store a new programme list for chanid and drop its outdated time index """
+        self.programs[chanid] = programmes
+        if chanid in self.time_index:
+            del self.time_index[chanid]
+
+        if chanid in self.start_times:
+            del self.start_times[chanid]
+
+    # end set_programmes()
+
+    def validate_channel(self, chanid, repair = None):
+        """
+        Check the programmes of chanid in time order for overlaps and gaps.
+        Each programme is compared with the one before for the same start
+        and with the one ending last so far for overlaps and gaps, so with
+        the sort this is O(n log n). With repair (seconds) overlaps are cut,
+        programmes with the same start dropped and gaps up to repair
+        closed. Returns the number of overlaps and gaps found.
+        """
+        starts, programmes = self.sorted_programmes(chanid)
+        stops = [xmltv_time(p.get('stop')) for p in programmes]
+        kept = []
+        # The kept programme with the latest stop time
+        last = None
+        overlaps = gaps = fixed = 0
+        for i in range(len(programmes)):
+            if len(kept) > 0 and starts[i] == starts[kept[-1]]:
+                j = kept[-1]
+                overlaps += 1
+                log(u'%s: "%s" and "%s" both start at %s\n' % \
+                        (chanid, programme_title(programmes[j]), programme_title(programmes[i]), programmes[i].get('start')))
+                if repair != None:
+                    fixed += 1
+                    continue
+
+            elif len(kept) > 0:
+                j = last
+                if stops[j] == None:
+                    if repair != None:
+                        programmes[j].set('stop', programmes[i].get('start'))
+                        stops[j] = starts[i]
+
+                elif stops[j] > starts[i]:
+                    overlaps += 1
+                    overlap = stops[j] if stops[i] == None else min(stops[i], stops[j])
+                    log(u'%s: "%s" at %s overlaps "%s" at %s by %s minutes\n' % \
+                            (chanid, programme_title(programmes[j]), programmes[j].get('start'),
+                            programme_title(programmes[i]), programmes[i].get('start'), (overlap - starts[i]) // 60))
+                    if repair != None:
+                        programmes[j].set('stop', programmes[i].get('start'))
+                        stops[j] = starts[i]
+                        fixed += 1
+
+                elif stops[j] < starts[i]:
+                    gaps += 1
+                    log(u'%s: a gap of %s minutes after "%s" at %s\n' % \
+                            (chanid, (starts[i] - stops[j]) // 60, programme_title(programmes[j]), programmes[j].get('start')))
+                    if repair != None and starts[i] - stops[j] <= repair:
+                        programmes[j].set('stop', programmes[i].get('start'))
+                        stops[j] = starts[i]
+                        fixed += 1
+
+            kept.append(i)
+            if last == None or stops[last] == None or (stops[i] != None and stops[i] > stops[last]):
+                last = i
+
+        if repair != None:
+            # Programmes without a start time can not be placed, they go last
+            new_list = [programmes[i] for i in kept]
+            if len(programmes) < len(self.programs[chanid]):
+                new_list.extend([p for p in self.programs[chanid] if xmltv_time(p.get('start')) == None])
+
+            self.set_programmes(chanid, new_list)
+
+        if overlaps > 0 or gaps > 0:
+            log(u'%s: %s overlaps and %s gaps found, %s repaired\n' % (chanid, overlaps, gaps, fixed))
+
+        return overlaps + gaps - fixed
+
+    # end validate_channel()
+
+    def validate_channels(self):
+        """ Validate the -x channels or without them all and return the problems left """
+        chanids = config.args.id_list if len(config.args.id_list) > 0 else self.chan_list
+        repair = None if config.args.repair == None else max(0, config.args.repair) * 60
+        problems = 0
+        for chanid in chanids:
+            if chanid in self.programs:
+                problems += self.validate_channel(chanid, repair)
+
+        log(u'Validated %s channels, %s problems left\n' % (len(chanids), problems))
+        return problems
+
+    # end validate_channels()
+
+    def new_id(self, chanid):
+        """ Return the xmltvID chanid gets from the operations or None if it is dropped """
+        for op in config.operations:
+            chanid = op.new_id(chanid)
+            if chanid == None:
+                break
+
+        return chanid
+
+    # end new_id()
+
+    def check_chanids(self):
+        cancel_processing = False
+        for chanid in config.args.id_list:
+            if not chanid in self.channel_index:
+                log(u'The requested xmltvID: "%s" is not found in the input file\n' % (chanid), 0)
+                cancel_processing = True
+            if config.args.add_new_id:
+                newid = self.new_id(chanid)
+                if newid == chanid:
+                    log(u'I can not add a new listing for "%s" without a new xmltvID.\n' % (chanid), 0)
+                    cancel_processing = True
+
+                elif newid in self.channel_index:
+                    log(u'I can not add the xmltvID: "%s". It already exists in the input file.\n' % (newid), 0)
+                    cancel_processing = True
+
+        if cancel_processing:
+            log(u'Canceling the processing of: %s\n' % (config.input_file), 0)
+            return False
+
+        return True
+
+    # end check_chanids()
+
+    def make_channel_jobs(self):
+        # All channel tags come before the programmes, so first collect per
+        # channel the listings to create as (old id, new id, action)
+        self.channel_jobs = []
+        for channel in self.channels:
+            listings = self.channel_listings(channel.get('id'))
+            if len(listings) > 0:
+                self.channel_jobs.append((channel, listings))
+
+    # end make_channel_jobs()
+
+    def channel_listings(self, chanid):
+        """ Return the listings to create for chanid as (old id, new id, action) """
+        listings = []
+        if chanid in config.args.id_list:
+            if config.args.add_new_id:
+                # preserve the old listings
+                listings.append((chanid, chanid, None))
+
+            newid = self.new_id(chanid)
+            if len(config.operations) == 0:
+                # nothing to do, so just pass it on
+                listings.append((chanid, chanid, None))
+
+            elif newid != None:
+                listings.append((chanid, newid, 'process'))
+
+        else:
+            listings.append((chanid, chanid, None))
+
+        return listings
+
+    # end channel_listings()
+
+    def write_channels(self):
+        """ Write the header and the channel tags of all channel jobs """
+        self.writer.write_header(self.output_header)
+        for channel, listings in self.channel_jobs:
+            self.write_channel(channel, listings)
+
+    # end write_channels()
+
+    def write_channel(self, channel, listings):
+        """ Write the channel tag once for every listing under its new xmltvID """
+        chanid = channel.get('id')
+        for old_id, newid, action in listings:
+            channel.set('id', newid)
+            self.writer.write_tag(channel, 2)
+            channel.set('id', chanid)
+
+    # end write_channel()
+
+    def process_requests(self):
+        if self.job_index != None:
+            # Streaming, so only what is kept is left to write
+            while self.next_job < len(self.channel_jobs):
+                self.finish_job(self.next_job)
+                self.next_job += 1
+
+            for index in sorted(self.late_jobs):
+                log(u'The programmes of %s are not in channel order, the later ones are written last\n' % \
+                        (self.channel_jobs[index][0].get('id')))
+                self.finish_job(index)
+
+            return
+
+        self.make_channel_jobs()
+        self.write_channels()
+
+        # Look up which channels can come from the cache
+        cached = {}
+        todo = range(len(self.channel_jobs))
+        if self.cache != None:
+            todo = []
+            for index in range(len(self.channel_jobs)):
+                text = self.cache.read(self.cache_key(index))
+                if text == None:
+                    todo.append(index)
+
+                else:
+                    cached[index] = text
+
+        # Now process and write the programmes one channel at a time
+        results = None
+        pool = None
+        jobs = config.channel_jobs
+        if jobs > 1 and len(todo) > 1 and multiprocessing != None and hasattr(os, 'fork'):
+            # The workers get this object through the fork and only return the rendered text
+            global shared_xml
+            shared_xml = self
+            flush_log()
+            pool = multiprocessing.Pool(min(jobs, len(todo)))
+            results = pool.imap(render_channel_job, todo)
+
+        try:
+            for index in range(len(self.channel_jobs)):
+                if index in cached:
+                    log(u'Reusing the cached listing for %s\n' % (self.channel_jobs[index][0].get('id')))
+                    self.writer.write(cached.pop(index))
+                    continue
+
+                entry = None
+                write = self.writer.write
+                if self.cache != None:
+                    entry = self.cache.open_entry(self.cache_key(index))
+
+                if entry != None:
+                    def write(text, entry = entry):
+                        self.writer.write(text)
+                        entry.write(text)
+
+                try:
+                    if results != None:
+                        if config.profile != None:
+                            mark = config.profile.mark()
+                            text = results.next()
+                            config.profile.add('workers', mark, 1)
+                            write(text)
+
+                        else:
+                            write(results.next())
+
+                    else:
+                        self.render_channel(index, write)
+
+                except:
+                    # Leave no half written entry in the cache
+                    if entry != None:
+                        entry.discard()
+
+                    raise
+
+                if entry != None:
+                    entry.close()
+
+        finally:
+            if pool != None:
+                pool.close()
+                pool.join()
+                shared_xml = None
+
+        if self.cache != None:
+            log(u'%s channel(s) reused from and %s written to the cache\n' % (self.cache.hits, self.cache.misses))
+            removed = self.cache.evict()
+            if removed > 0:
+                log(u'Removed %s old file(s) from the cache\n' % (removed))
+
+    # end process_requests()
+
+    def render_channel(self, index, write):
+        """ Process the listings of one channel job and pass the rendered programmes to write """
+        channel, listings = self.channel_jobs[index]
+        for chanid, newid, action in listings:
+            if action == None:
+                log(u'Preserving the old listing for %s\n' % (chanid))
+                self.create_output(chanid, write)
+
+            else:
+                self.process_channel(chanid, newid, write)
+
+    # end render_channel()
+
+    def process_channel(self, chanid, newid, write):
+        """
+        Run all operations on the programmes of chanid and render each
+        programme right after, so any chain of edits takes one pass.
+        Without write the programmes are only edited.
+        """
+        ops = config.operations
+        for op in ops:
+            op.start(chanid)
+
+        programmes = []
+        timer = config.profile
+        for p in self.programs.get(chanid, []):
+            if timer != None:
+                mark = timer.mark()
+
+            for op in ops:
+                p = op.apply(p, chanid)
+                if p == None:
                     break
 
-            # for other child tags and any remaining ones
-            for t in sdict['tags']:
-                if not t['tag'] in processed:
-                    out_str += create_tag(t['tag'], t['value'], ident + 2)
+            else:
+                if newid != chanid:
+                    p.set('channel', newid)
+
+                programmes.append(p)
+                if write == None:
+                    if timer != None:
+                        timer.add('transform', mark, 1)
+
+                elif timer != None:
+                    mark = timer.add('transform', mark, 1)
+                    text = self.writer.create_tag(p, 2)
+                    timer.add('serialize', mark, 1)
+                    write(text)
+
+                else:
+                    write(self.writer.create_tag(p, 2))
+
+                continue
+
+            if timer != None:
+                timer.add('transform', mark, 1)
+
+        for op in ops:
+            op.finish(chanid)
+
+        log(u'Creating the new listing for %s\n' % (newid))
+        self.set_programmes(newid, programmes)
+        if newid != chanid and not config.args.add_new_id:
+            del self.programs[chanid]
+
+    # end process_channel()
+
+    def channel_tags(self):
+        """ Return the rendered channel tags of the channel jobs as (xmltvID, text) """
+        channel_tags = []
+        for channel, listings in self.channel_jobs:
+            for chanid, newid, action in listings:
+                channel.set('id', newid)
+                channel_tags.append((newid, self.writer.create_tag(channel, 2)))
+                channel.set('id', chanid)
+
+        return channel_tags
+
+    # end channel_tags()
+
+    def processed_listings(self):
+        """ Process the channel jobs one by one and yield (xmltvID, programmes) """
+        for channel, listings in self.channel_jobs:
+            for chanid, newid, action in listings:
+                if action == None:
+                    log(u'Preserving the old listing for %s\n' % (chanid))
+                    yield (chanid, self.programs.get(chanid, []))
+
+                else:
+                    self.process_channel(chanid, newid, None)
+                    yield (newid, self.programs.get(newid, []))
+
+    # end processed_listings()
+
+    def export_db(self, path):
+        """
+        Write the result into a new SQLite database at path. Every row keeps
+        the rendered programme, so --query-db only has to select and copy.
+        The rows of a channel go in with one executemany and everything in
+        one transaction, the indexes are made afterwards.
+        """
+        self.make_channel_jobs()
+        path = os.path.realpath(path)
+        handle, temp_path = temp_file(path, '.export.')
+        os.close(handle)
+        db = sqlite3.connect(temp_path)
+        try:
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('PRAGMA journal_mode = MEMORY')
+            db.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+            db.execute('CREATE TABLE channels (id TEXT PRIMARY KEY, pos INTEGER, xml TEXT)')
+            db.execute('CREATE TABLE programmes (channel TEXT, start INTEGER, stop INTEGER, title TEXT, xml TEXT)')
+            channel_tags = self.channel_tags()
+            db.executemany('INSERT INTO channels VALUES (?, ?, ?)',
+                    [(channel_tags[i][0], i, channel_tags[i][1]) for i in range(len(channel_tags))])
+
+            count = 0
+            longest = 0
+            for chanid, programmes in self.processed_listings():
+                rows = []
+                for p in programmes:
+                    start = xmltv_time(p.get('start'))
+                    stop = xmltv_time(p.get('stop'))
+                    if stop == None or start == None:
+                        stop = start
+
+                    elif stop - start > longest:
+                        longest = stop - start
+
+                    rows.append((chanid, start, stop, programme_title(p), self.writer.create_tag(p, 2)))
+
+                db.executemany('INSERT INTO programmes VALUES (?, ?, ?, ?, ?)', rows)
+                count += len(rows)
+
+            # With the longest programme a search on time only has to look back that far
+            db.executemany('INSERT INTO meta VALUES (?, ?)', [(u'header', self.output_header),
+                    (u'version', config.version(True)), (u'longest', unicode(longest))])
+            db.execute('CREATE INDEX programmes_channel ON programmes (channel, start)')
+            db.execute('CREATE INDEX programmes_start ON programmes (start)')
+            db.commit()
+            db.close()
+            replace_file(temp_path, path)
+
+        except:
+            db.close()
+            os.remove(temp_path)
+            raise
+
+        log(u'Exported %s channels and %s programmes to %s\n' % (len(channel_tags), count, path))
+
+    # end export_db()
+
+    def split_output(self, mode, out_dir):
+        """
+        Write every channel, or every day, with the header and the channel
+        tags as a file of its own into out_dir. The files are rendered here
+        and handed to the Shard_Writer threads through a bounded queue.
+        The days cross the channels, so those can only go at the end.
+        """
+        self.make_channel_jobs()
+        channel_tags = self.channel_tags()
+        tag_index = dict(channel_tags)
+        days = {}
+        shards = Shard_Writer(out_dir, config.split_writers)
+        complete = False
+        try:
+            for newid, programmes in self.processed_listings():
+                if mode == 'channel':
+                    text = [self.output_header, tag_index[newid]]
+                    text.extend([self.writer.create_tag(p, 2) for p in programmes])
+                    text.append(u'</tv>\n')
+                    shards.put(shard_name(newid), u''.join(text))
+                    continue
+
+                for p in programmes:
+                    start = p.get('start', u'')
+                    day = u'%s-%s-%s' % (start[0:4], start[4:6], start[6:8]) if start[0:8].isdigit() else u'undated'
+                    if not day in days:
+                        days[day] = []
+
+                    days[day].append(self.writer.create_tag(p, 2))
+
+            if mode == 'day':
+                tags = u''.join([t for chanid, t in channel_tags])
+                for day in sorted(days.keys()):
+                    shards.put(u'%s.xml' % day, u''.join([self.output_header, tags] + days.pop(day) + [u'</tv>\n']))
+
+            complete = True
+
+        finally:
+            removed = shards.close(complete)
 
-            # close the tag and return
-            return u'%s%s</%s>\n' % (out_str, ''.rjust(ident), name)
+        for error in shards.errors:
+            log(u'Error writing %s\n' % error, 0)
 
+        log(u'%s file(s) written, %s unchanged and %s old one(s) removed in %s\n' % \
+                (shards.written, shards.unchanged, removed, out_dir))
+        return 1 if len(shards.errors) > 0 else None
+
+    # end split_output()
+
+    def create_output(self, chanid = None, write = None):
+        """
+        Write the programmes of chanid to the output or pass them to write
+        Without a chanid close the output with the endtag
+        """
         if chanid == None:
-            self.out_string = self.output_header
-            self.out_string += self.chan_out_string
-            self.out_string += self.prog_out_string
-            self.out_string += u'</tv>\n'
+            self.writer.write_footer()
 
         else:
-            for c in self.channels:
-                if c['attribs']['id'] == chanid:
-                    self.chan_out_string += create_tag(u'channel', c, 2)
+            if write == None:
+                write = self.writer.write
 
+            timer = config.profile
             for p in self.programs[chanid]:
-                self.prog_out_string += create_tag(u'programme', p, 2)
+                if timer != None:
+                    mark = timer.mark()
+                    text = self.writer.create_tag(p, 2)
+                    timer.add('serialize', mark, 1)
+                    write(text)
 
+                else:
+                    write(self.writer.create_tag(p, 2))
 
     # create_output()
 
 # end process_xml_file()
 
-def main():
-    try:
-        # Process the commandline etc
-        x = config.read_commandline()
-        if x != None:
-            return(x)
+class Merge_XML():
+    """
+    Merge several xmltv sources into one output. Each source is parsed
+    incrementally and every programme is rendered as soon as it is read,
+    so of a programme only (start, stop, priority, sequence, text) is kept.
+    The programmes of a channel are then merged on start time over all
+    sources with a heap. The first source has the highest priority.
+    """
+    def __init__(self, sources):
+        # A list of (name, stream)
+        self.sources = sources
+        self.output_header = None
+        self.chan_list = []
+        # xmltvID -> the rendered channel tag, taken from the first source that has it
+        self.channel_index = {}
+        # xmltvID -> priority -> list of programme tuples
+        self.programs = {}
+        self.programme_count = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.writer = XMLTV_Writer(config.output)
+    # end Init()
 
-        xml = Process_XML()
-        # read in a xmltv file
-        x = xml.read_input()
-        if x != None:
-            return(x)
+    def read_source(self, priority):
+        """ Parse one source and collect its channels and rendered programmes """
+        name, source = self.sources[priority]
+        try:
+            header, et_object = open_parser(source)
+            if self.output_header == None:
+                self.output_header = header
+
+            root = None
+            count = 0
+            for event, elem in et_object:
+                if root == None:
+                    root = elem
+                    continue
+
+                if event != 'end':
+                    continue
+
+                if elem.tag == 'channel':
+                    c_id = elem.get('id')
+                    if c_id != None and c_id != '' and not c_id in self.channel_index:
+                        self.chan_list.append(c_id)
+                        self.channel_index[c_id] = self.writer.create_tag(elem, 2)
+
+                elif elem.tag == 'programme':
+                    c_id = elem.get('channel')
+                    if c_id != None and c_id != '':
+                        start = xmltv_time(elem.get('start'))
+                        stop = xmltv_time(elem.get('stop'))
+                        if start == None:
+                            start = stop = -1
+
+                        elif stop == None:
+                            stop = start
+
+                        if (config.time_from != None and start != -1 and start < config.time_from and stop <= config.time_from) or \
+                          (config.time_until != None and start >= config.time_until):
+                            self.skipped += 1
+
+                        else:
+                            if not c_id in self.programs:
+                                self.programs[c_id] = {}
+
+                            if not priority in self.programs[c_id]:
+                                self.programs[c_id][priority] = []
+
+                            # Kept encoded, which takes a quarter of the memory of unicode
+                            text = self.writer.create_tag(elem, 2).encode('utf-8')
+                            self.programs[c_id][priority].append((start, stop, priority, count, text))
+                            count += 1
+
+                else:
+                    continue
+
+                root.clear()
+
+        except:
+            log(u'error: %s parsing %s\n' % (sys.exc_info()[1], name), 0)
+            return 2
+
+        log(u'Read %s programmes from %s\n' % (count, name))
+        self.programme_count += count
+
+    # end read_source()
+
+    def merge_channel(self, chanid):
+        """
+        Return the programmes of chanid over all sources in start order.
+        A programme overlapping one from a source with a higher priority
+        is left out, on a tie the one read first stays.
+        """
+        sources = self.programs.pop(chanid, {})
+        streams = []
+        for priority in sorted(sources.keys()):
+            # Mostly already in order, which makes this a single pass
+            sources[priority].sort()
+            streams.append(sources[priority])
+
+        merged = []
+        for p in heapq.merge(*streams):
+            if len(merged) > 0 and p[0] != -1:
+                last = merged[-1]
+                if last[1] > p[0] or last[0] == p[0]:
+                    self.dropped += 1
+                    if last[2] <= p[2]:
+                        continue
+
+                    merged.pop()
+
+            merged.append(p)
+
+        return merged
+
+    # end merge_channel()
+
+    def process_merge(self):
+        timer = config.profile
+        if timer != None:
+            mark = timer.mark()
+
+        for priority in range(len(self.sources)):
+            x = self.read_source(priority)
+            if x != None:
+                return(x)
+
+        if timer != None:
+            # The programmes are rendered while reading, so this includes serializing
+            mark = timer.add('parse', mark, self.programme_count)
+
+        self.writer.write_header(self.output_header or u'<tv>\n')
+        for chanid in self.chan_list:
+            self.writer.write(self.channel_index[chanid])
+
+        written = 0
+        for chanid in self.chan_list:
+            for p in self.merge_channel(chanid):
+                self.writer.write(p[4].decode('utf-8'))
+                written += 1
+
+        self.writer.write_footer()
+        if timer != None:
+            timer.add('transform', mark, written)
+            timer.subtract('transform', 'write')
+            timer.report()
+
+        if config.time_from != None or config.time_until != None:
+            log(u'Skipped %s programmes outside the requested time window\n' % (self.skipped))
+
+        if len(self.programs) > 0:
+            log(u'Left out the programmes of %s xmltvIDs without a channel tag\n' % (len(self.programs)))
+
+        log(u'Merged %s files into %s channels and %s programmes, %s overlapping programmes left out\n' % \
+                (len(self.sources), len(self.chan_list), written, self.dropped))
+        config.counters['channels'] = len(self.chan_list)
+        config.counters['programmes'] = written
+
+    # end process_merge()
+
+# end Merge_XML
+
+# The Process_XML object the channel workers inherit from process_requests
+shared_xml = None
+
+def render_channel_job(index):
+    """ Render one channel job of shared_xml in a worker process and return the text """
+    fragments = []
+    shared_xml.render_channel(index, fragments.append)
+    # A worker exits without flushing, so write its log lines now
+    flush_log()
+    return u''.join(fragments)
+
+# end render_channel_job()
+
+def log_exception():
+    # Log the last exception with a traceback of line numbers
+    err_obj = sys.exc_info()[2]
+    log(u'\nAn unexpected error has occured at line: %s, %s: %s\n' %  (err_obj.tb_lineno, err_obj.tb_lasti, sys.exc_info()[1]), 0)
+
+    while True:
+        err_obj = err_obj.tb_next
+        if err_obj == None:
+            break
+
+        log(u'                   tracing back to line: %s, %s\n' %  (err_obj.tb_lineno, err_obj.tb_lasti), 0)
+
+    log(u'\nIf you want assistence, please attach your log file!\n     %s\n' % (config.log_file),0)
+    flush_log()
+
+# end log_exception()
+
+def process_file():
+    """ Process the files opened by config.init_files and return the exit code """
+    try:
+        cache = None
+        if config.args.cache_dir != None:
+            cache = config.open_cache(config.args.cache_dir)
+            if cache == None:
+                return(1)
 
-        xml.process_xml()
+        keep_ids = config.args.id_list if config.args.extract else None
+        edit_ids = config.args.id_list if len(config.operations) > 0 else []
+        xml = Process_XML(edit_ids, cache, keep_ids)
+        timer = config.profile
+        if timer != None:
+            mark = timer.mark()
+
+        snapshot = config.args.snapshot
+        if snapshot != None and config.input_file == u'<stdin>':
+            log(u'A snapshot can not be used with stdin\n')
+            snapshot = None
+
+        # Unless all programmes are needed at once, those of the channels
+        # that are not edited are written while parsing
+        xml.stream = cache == None and snapshot == None and not config.args.validate and \
+                config.args.repair == None and config.args.export_db == None and \
+                config.args.split == None and config.channel_jobs == 1
+
+        if snapshot == None or not xml.load_snapshot(snapshot):
+            if snapshot != None:
+                xml.snapshot = ([], [])
+
+            # read in a xmltv file
+            x = xml.read_input()
+            if x != None:
+                return(x)
+
+            x = xml.process_xml()
+            if x != None:
+                return(x)
+
+            if snapshot != None:
+                xml.save_snapshot(snapshot)
+
+        config.counters['channels'] = len(xml.channels)
+        config.counters['programmes'] = xml.programme_count
+        if timer != None:
+            mark = timer.add('parse', mark, config.counters['channels'] + config.counters['programmes'])
+            timer.subtract('parse', 'convert')
 
         # Check if the requested xmltvID's are present and processable
         if not xml.check_chanids():
             return(1)
 
-        # do any processing
-        xml.process_requests()
+        problems = 0
+        if config.args.validate or config.args.repair != None:
+            problems = xml.validate_channels()
 
-        # create the new xmltv output
-        xml.create_output()
-        # and write it to file
-        config.output.write(xml.out_string)
+        if timer != None:
+            timer.add('check', mark, len(xml.channels))
 
-    except:
-        err_obj = sys.exc_info()[2]
-        log(u'\nAn unexpected error has occured at line: %s, %s: %s\n' %  (err_obj.tb_lineno, err_obj.tb_lasti, sys.exc_info()[1]), 0)
+        if config.args.export_db != None:
+            xml.export_db(config.args.export_db)
 
-        while True:
-            err_obj = err_obj.tb_next
-            if err_obj == None:
-                break
+        elif config.args.split != None:
+            x = xml.split_output(config.args.split, config.output_file)
+            if x != None:
+                return(x)
+
+        else:
+            # do any processing while writing the channels and programmes
+            xml.process_requests()
+
+            # and close the xmltv output
+            xml.create_output()
 
-            log(u'                   tracing back to line: %s, %s\n' %  (err_obj.tb_lineno, err_obj.tb_lasti), 0)
+        if timer != None:
+            timer.report()
 
-        log(u'\nIf you want assistence, please attach your log file!\n     %s\n' % (config.log_file),0)
+        if problems > 0:
+            return(3)
+
+    except:
+        log_exception()
         return(99)
 
     # and return success
     return(0)
+
+# end process_file()
+
+def merge_files():
+    """ Merge config.input with the --merge files into the output and return the exit code """
+    sources = [(config.input_file, config.input)]
+    try:
+        for name in config.args.merge:
+            name = os.path.realpath(name)
+            source = config.open_input(name)
+            if source == None:
+                return(1)
+
+            sources.append((name, source))
+
+        x = Merge_XML(sources).process_merge()
+        if x != None:
+            return(x)
+
+    except:
+        log_exception()
+        return(99)
+
+    finally:
+        for name, source in sources[1:]:
+            source.close()
+
+    return(0)
+
+# end merge_files()
+
+def query_db():
+    """
+    Write the channels and programmes selected with -x, --from and --until
+    from a --export-db database as xmltv and return the exit code
+    """
+    try:
+        db = sqlite3.connect(config.args.query_db)
+        meta = dict(db.execute('SELECT name, value FROM meta').fetchall())
+        chanids = config.args.id_list
+        if len(chanids) > 0:
+            channels = db.execute('SELECT id, xml FROM channels WHERE id IN (%s) ORDER BY pos' % \
+                    u', '.join([u'?'] * len(chanids)), chanids).fetchall()
+
+        else:
+            channels = db.execute('SELECT id, xml FROM channels ORDER BY pos').fetchall()
+
+        for chanid in chanids:
+            if not chanid in [c[0] for c in channels]:
+                log(u'The requested xmltvID: "%s" is not found in the database\n' % (chanid), 0)
+
+        # Those running at --from started at most the longest programme before it
+        query = 'SELECT xml FROM programmes WHERE channel = ?'
+        values = []
+        if config.time_from != None:
+            query += ' AND start >= ? AND stop > ?'
+            values.extend([config.time_from - int(meta.get(u'longest', 0)), config.time_from])
+
+        if config.time_until != None:
+            query += ' AND start < ?'
+            values.append(config.time_until)
+
+        query += ' ORDER BY start'
+        writer = XMLTV_Writer(config.output)
+        writer.write_header(meta.get(u'header', u'<tv>\n'))
+        for chanid, xml in channels:
+            writer.write(xml)
+
+        count = 0
+        for chanid, xml in channels:
+            for row in db.execute(query, [chanid] + values):
+                writer.write(row[0])
+                count += 1
+
+        writer.write_footer()
+        db.close()
+        log(u'Selected %s programmes on %s channels from %s\n' % (count, len(channels), config.args.query_db))
+
+    except sqlite3.Error as e:
+        log(u'Error reading %s: %s\n' % (config.args.query_db, e), 0)
+        return(1)
+
+    except:
+        log_exception()
+        return(99)
+
+    return(0)
+
+# end query_db()
+
+def file_states(file_names):
+    """ Return the (mtime, size) of the files, None for a missing one """
+    states = []
+    for file_name in file_names:
+        try:
+            stat = os.stat(file_name)
+            states.append((stat.st_mtime, stat.st_size))
+
+        except OSError:
+            states.append(None)
+
+    return tuple(states)
+
+# end file_states()
+
+def watch(run):
+    """
+    Call run now and again every time the input, or a --merge file, changes.
+    Configuration, operations and rank tables stay as they are between the
+    cycles. A change is only acted on when the files did not change for
+    config.watch_settle seconds, so a grabber still writing is waited for.
+    """
+    file_names = [config.input_file]
+    if config.args.merge != None:
+        file_names.extend([os.path.realpath(f) for f in config.args.merge])
+
+    interval = max(1, config.args.watch)
+    log(u'Watching %s every %s seconds\n' % (u', '.join(file_names), interval))
+    # Every cycle opens them again when the input is complete
+    config.close_files(False)
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    # Ctrl-C and SIGTERM only stop it between the cycles, so a cycle
+    # always commits or discards its output
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    def pause(seconds):
+        end = time.time() + seconds
+        while not stopping and time.time() < end:
+            time.sleep(min(1, end - time.time()))
+
+    last_state = None
+    cycle = 0
+    while not stopping:
+        state = file_states(file_names)
+        if state != last_state and not None in state:
+            # Wait until it is complete
+            while True:
+                pause(config.watch_settle)
+                new_state = file_states(file_names)
+                if stopping or new_state == state:
+                    break
+
+                state = new_state
+
+            if stopping:
+                break
+
+            config.counters = {}
+            if config.profile != None:
+                config.profile = Phase_Timer()
+
+            cycle += 1
+            start = time.time()
+            start_cpu = cpu_time()
+            # A window like --until +48h moves along with every cycle
+            x = config.init_time_window()
+            if x == None:
+                x = config.reopen_files()
+
+            if x == None:
+                x = run()
+
+            config.close_files(x in (0, 3))
+            log(u'Cycle %s: exit code %s, %s programmes in %.2f seconds, %.2f seconds CPU\n' % \
+                    (cycle, x, config.counters.get('programmes', 0), time.time() - start, cpu_time() - start_cpu))
+            # Or it waits for the next change
+            flush_log()
+            last_state = state
+
+        pause(interval)
+
+    log(u'Stopped watching after %s cycles\n' % cycle)
+    return(0)
+
+# end watch()
+
+def process_batch_file(job):
+    """
+    Process one file of a batch with its own configuration and log.
+    Runs in a worker process and returns a tuple with the results.
+    """
+    global config
+    input_file, output_file, args = job
+    parent_config = config
+    stderr = sys.stderr
+    start = time.time()
+    config = Configure()
+    config.args = args
+    config.quiet = True
+    config.buffer_size = parent_config.buffer_size
+    config.compress_level = parent_config.compress_level
+    if args.profile:
+        config.profile = Phase_Timer()
+
+    config.init_operations()
+    config.init_time_window()
+    x = config.init_files(input_file, output_file)
+    if x == None:
+        x = process_file()
+
+    config.close(x in (0, 3))
+    result = (input_file, output_file, x, time.time() - start, config.counters.get('programmes', 0))
+    sys.stderr = stderr
+    config = parent_config
+    return result
+
+# end process_batch_file()
+
+def process_batch():
+    """
+    Process all files of a batch in a pool of worker processes
+    and report the time and throughput per file
+    """
+    jobs = [(input_file, output_file, config.args) for input_file, output_file in config.batch_jobs]
+    workers = config.args.jobs
+    if workers == None:
+        workers = 1 if multiprocessing == None else multiprocessing.cpu_count()
+
+    workers = max(1, min(workers, len(jobs)))
+    log(u'Processing %s files with %s worker(s)\n' % (len(jobs), workers))
+    start = time.time()
+    if workers > 1 and multiprocessing != None:
+        # Or the workers would inherit the waiting lines
+        flush_log()
+        pool = multiprocessing.Pool(workers)
+        results = pool.map(process_batch_file, jobs, 1)
+        pool.close()
+        pool.join()
+
+    else:
+        results = [process_batch_file(job) for job in jobs]
+
+    x = 0
+    total = 0
+    for input_file, output_file, code, seconds, programmes in results:
+        total += programmes
+        if code != 0:
+            log(u'Processing %s failed with exit code %s. See %s.log\n' % (input_file, code, input_file), 0)
+            x = max(x, code)
+            continue
+
+        size = os.path.getsize(input_file) / 1048576.0
+        log(u'%s -> %s: %.2f seconds, %s programmes, %.0f programmes/s, %.1f MB/s\n' % \
+                (input_file, output_file, seconds, programmes, programmes / max(seconds, 0.001), size / max(seconds, 0.001)))
+
+    seconds = time.time() - start
+    log(u'Processed %s files with %s programmes in %.2f seconds, %.0f programmes/s\n' % \
+            (len(jobs), total, seconds, total / max(seconds, 0.001)))
+    return(x)
+
+# end process_batch()
+
+def main(argv = None):
+    try:
+        # Process the commandline etc
+        x = config.read_commandline(argv)
+        if x != None:
+            return(x)
+
+    except:
+        log_exception()
+        return(99)
+
+    if config.args.query_db != None:
+        run = query_db
+
+    elif config.batch_jobs != None:
+        run = process_batch
+
+    elif config.args.merge != None:
+        run = merge_files
+
+    else:
+        run = process_file
+
+    if config.args.watch != None:
+        return watch(run)
+
+    if config.args.profile_stats == None:
+        return run()
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run)
+
+    finally:
+        profiler.dump_stats(config.args.profile_stats)
+        log(u'Saved the cProfile statistics in %s\n' % config.args.profile_stats)
+
 # end main()
 
 # allow this to be a module
 if __name__ == '__main__':
     x = main()
-    config.close()
+    # With 3 validation found problems, but the output is complete
+    config.close(x in (0, 3))
     sys.exit(x)